@@ -20,6 +20,7 @@ class ArithmeticEquationSimplification():
     def __init__(self, operators, N):
         super().__init__()
         self.operators = operators
+        self.N = N
         self.pos_digits = np.arange(2, N+2).tolist()
         self.neg_digits = np.arange(-N, -1).tolist()
         self.digits = self.pos_digits + self.neg_digits
@@ -27,19 +28,16 @@ class ArithmeticEquationSimplification():
     def gen_base_dict(self):
         return {str(i):[] for i in self.pos_digits}
     
+    def gen_vocab(self):
+        return gen_vocab(self.operators, self.pos_digits)
+    
+    def gen_store(self, L, verify=False):
+        return EquationStore(self.operators, [int(v) for v in self.gen_base_dict()], L, verify)
+    
     def expand_base_dict(self):
-        for a in self.digits:
-            for o in self.operators:
-                for b in self.pos_digits:
-                    try:
-                        e = [str(a), o, str(b)]
-                        v = str(eval(''.join(e)))
-                        e[0] = e[0].replace('-', '- ')
-                        e = ' '.join(list(e))
-                        if v in self.base_dict:
-                            self.base_dict[v].append('( {} )'.format(e))
-                    except:
-                        pass
+        # sub-expressions of each value
+        # loaded from the cache keyed by N and operators
+        self.base_dict = load_base_dict(self.digits, self.pos_digits, self.operators)
     
     def gen_operation(self, L):
         if L == 1:
@@ -51,66 +49,58 @@ class ArithmeticEquationSimplification():
             b = np.random.choice(self.pos_digits)
             return left_side + [o, str(b)]
     
-    def gen_operation_list(self, L, D):
-        # to control the data size
-        operations_pool = set()
-        for i in tqdm(range(D)):
-            while True: 
-                # to avoid duplicates
-                operation = self.gen_operation(L) 
-                if ''.join(operation) in operations_pool: 
-                    continue
-                else:
-                    operations_pool.add(''.join(operation)) 
-                # to avoid zero division error
-                try: 
-                    # flost to int to string
-                    value = eval(''.join(operation))
-                    if value % 1 != 0.: 
-                        continue
-                    else:
-                        value = str(int(value))
-                        # to keep vocab size
-                        if value in self.value_dict: 
-                            self.value_dict[value].append(operation)
-                            break
-                except: 
-                    pass
+    def gen_operation_list(self, L, D, batch_size=0, workers=1, seed=None, sampler='rejection'):
+        # the left sides of D unique equations in the store
+        sample_operation_list(self, self.digits, self.pos_digits, L, D, batch_size, workers, seed, sampler)
+    
+    def gen_equation(self, v, y):
+        y = y[0].replace('-', '- ').split() + y[1:]
+        y += ["=="] + [v]
+        return ' '.join(y)
     
     def gen_equation_list(self):
-        ys = []
-        for v in self.value_dict:
-            for y in self.value_dict[v]:
-                y = y[0].replace('-', '- ').split() + y[1:]
-                y += ["=="] + [v]
-                ys.append(' '.join(y))
-        return ys
+        return [self.gen_equation(v, y) for v, y in self.store.gen_operations()]
     
     def replace_numbers(self, ys):
-        xs = []
-        for y in ys:
-            y = y.split()
-            num_idx = [i for i, token in enumerate(y) if token.isdigit()]
-            num_to_replace = np.random.choice(range(len(num_idx)+1))
-            idx_to_replace = np.random.choice(num_idx, num_to_replace, False)
-            for i in idx_to_replace:
-                y[i] = np.random.choice(self.base_dict[y[i]])
-            xs.append(' '.join(y))
-        return xs
+        # replace some integers of all equations by sub-expressions at once
+        vocab = self.gen_vocab()
+        ids, _ = encode_batch(ys, vocab)
+        symbols, start, count = gen_sub_table(vocab, self.base_dict)
+        return decode_batch(replace_batch(ids, symbols, start, count), symbols)
                 
-    def generate(self, L, D):
+    def generate(self, L, D, batch_size=0, workers=1, seed=None, sampler='rejection', verify=False):
         # input sequences, output sequences
         xs, ys = [], []
         self.base_dict = self.gen_base_dict()
-        self.value_dict = self.gen_base_dict()
+        self.store = self.gen_store(L, verify)
         self.expand_base_dict()
         self.gen_operation_list(
             L=L, 
-            D=D)
+            D=D, 
+            batch_size=batch_size, 
+            workers=workers, 
+            seed=seed, 
+            sampler=sampler)
         ys = self.gen_equation_list()
         xs = self.replace_numbers(ys)
         
         return xs, ys
+    
+    def stream(self, L, D, batch_size=0, workers=1, seed=None, sampler='rejection', verify=False):
+        # input and output sequences one pair at a time in a random order
+        self.base_dict = self.gen_base_dict()
+        self.store = self.gen_store(L, verify)
+        self.expand_base_dict()
+        self.gen_operation_list(
+            L=L, 
+            D=D, 
+            batch_size=batch_size, 
+            workers=workers, 
+            seed=seed, 
+            sampler=sampler)
+        equations = (self.gen_equation(v, y) for v, y in self.store.gen_operations(shuffle=True))
+        for ys in gen_chunks(equations): 
+            yield from zip(self.replace_numbers(ys), ys)
 
 def train_test_split(xs, ys): 
     # train val test split
@@ -132,7 +122,7 @@ def train_test_split(xs, ys):
 
     return trainset, valset, testset
 
-def save_dataset(trainset, valset, testset, args): 
+def get_outdir(args): 
     outdir = 'aes' 
     outdir = os.path.join(
         outdir, 
@@ -143,13 +133,11 @@ def save_dataset(trainset, valset, testset, args):
     if not os.path.exists(outdir): 
         os.makedirs(outdir)
 
-    save_txt(os.path.join(outdir, 'train_x.txt'), trainset[:, 0])
-    save_txt(os.path.join(outdir, 'train_y.txt'), trainset[:, 1])
-    save_txt(os.path.join(outdir, 'val_x.txt'), valset[:, 0])
-    save_txt(os.path.join(outdir, 'val_y.txt'), valset[:, 1])
-    save_txt(os.path.join(outdir, 'test_x.txt'), testset[:, 0])
-    save_txt(os.path.join(outdir, 'test_y.txt'), testset[:, 1])
+    return outdir
 
+def save_dataset(trainset, valset, testset, args, vocab=None): 
+    outdir = get_outdir(args)
+    save_dataset_splits(outdir, trainset, valset, testset, vocab)
     print("find output from", outdir)
 
 def main():
@@ -169,15 +157,65 @@ def main():
         type=int, 
         required=True, 
         help='defines the number of unique equations')
+    parser.add_argument('--batch_size', 
+        type=int, 
+        default=4096, 
+        help='defines the number of candidates drawn at once, 0 to draw one by one')
+    parser.add_argument('--workers', 
+        type=int, 
+        default=1, 
+        help='defines the number of processes to generate equations')
+    parser.add_argument('--seed', 
+        type=int, 
+        default=None, 
+        help='defines the random seed for reproducible generation')
+    parser.add_argument('--sampler', 
+        type=str, 
+        default='rejection', 
+        choices=['rejection', 'enumeration'], 
+        help='defines how to sample equations, enumeration for small N and L')
+    parser.add_argument('--verify', 
+        action='store_true', 
+        help='compares equations on hash collisions instead of trusting 64-bit hashes')
+    parser.add_argument('--format', 
+        type=str, 
+        default='txt', 
+        choices=['txt', 'npy'], 
+        help='defines the output format, npy for int16 token ids with offsets and a vocab')
+    parser.add_argument('--stream', 
+        action='store_true', 
+        help='writes each equation to its split file as it is generated to keep memory flat')
     args = parser.parse_args()
+    if args.seed is not None: 
+        np.random.seed(args.seed)
     # data generation 
     operators = ['+', '-', '*', '/'] 
     aes = ArithmeticEquationSimplification(operators, args.N) 
-    xs, ys = aes.generate(
-        L=args.L-1, 
-        D=args.D)
-    trainset, valset, testset = train_test_split(xs, ys)
-    save_dataset(trainset, valset, testset, args)
+    vocab = aes.gen_vocab() if args.format == 'npy' else None
+    if args.stream: 
+        pairs = aes.stream(
+            L=args.L-1, 
+            D=args.D, 
+            batch_size=args.batch_size, 
+            workers=args.workers, 
+            seed=args.seed, 
+            sampler=args.sampler, 
+            verify=args.verify)
+        outdir = get_outdir(args)
+        stream_dataset(pairs, args.D, outdir, vocab)
+        print("find output from", outdir)
+    else: 
+        xs, ys = aes.generate(
+            L=args.L-1, 
+            D=args.D, 
+            batch_size=args.batch_size, 
+            workers=args.workers, 
+            seed=args.seed, 
+            sampler=args.sampler, 
+            verify=args.verify)
+        trainset, valset, testset = train_test_split(xs, ys)
+        save_dataset(trainset, valset, testset, args, vocab)
+    print('peak RSS {:.1f} MB'.format(get_peak_rss()))
 
 if __name__ == '__main__': 
     main()
\ No newline at end of file
@@ -20,6 +20,7 @@ class ArithmeticOperatorRestoration():
     def __init__(self, operators, N):
         super(ArithmeticOperatorRestoration, self).__init__()
         self.operators = operators
+        self.N = N
         self.pos_digits_pool = np.arange(2, N+2).tolist()
         self.neg_digits_pool = np.arange(-N, -1).tolist()
         self.digits_pool = self.pos_digits_pool + self.neg_digits_pool
@@ -28,6 +29,14 @@ class ArithmeticOperatorRestoration():
         # initialize a base value dict
         return {str(i):[] for i in self.pos_digits_pool}
         
+    def gen_vocab(self):
+        # tokens to save token ids
+        return gen_vocab(self.operators, self.pos_digits_pool)
+        
+    def gen_store(self, L, verify=False):
+        # array-backed left sides with values in the base value dict
+        return EquationStore(self.operators, [int(v) for v in self.gen_base_dict()], L, verify)
+        
     def gen_operation(self, L):
         # a recursion to geneate  the left side of an equation
         if L == 1:
@@ -39,58 +48,57 @@ class ArithmeticOperatorRestoration():
             b = np.random.choice(self.pos_digits_pool)
             return left_side + [operator, str(b)]
     
-    def gen_operation_list(self, L, D):
-        # to control the data size
-        operations_pool = set()
-        for i in tqdm(range(D)):
-            while True: 
-                # to avoid duplicates
-                operation = self.gen_operation(L) 
-                if ''.join(operation) in operations_pool: 
-                    continue
-                else:
-                    operations_pool.add(''.join(operation)) 
-                # to avoid zero division error
-                try: 
-                    # flost to int to string
-                    value = eval(''.join(operation))
-                    if value % 1 != 0.: 
-                        continue
-                    else:
-                        value = str(int(value))
-                        # to keep vocab size
-                        if value in self.value_dict: 
-                            self.value_dict[value].append(operation)
-                            break
-                except: 
-                    pass
+    def gen_operation_list(self, L, D, batch_size=0, workers=1, seed=None, sampler='rejection'):
+        # the left sides of D unique equations in the store
+        sample_operation_list(self, self.digits_pool, self.pos_digits_pool, L, D, batch_size, workers, seed, sampler)
     
-    def gen_equation_list(self):
+    def gen_equation(self, v, x):
         # generate the relational equation
-        # given the value dict
-        for v in self.value_dict:
-            for x in self.value_dict[v]:
-                x = x[0].replace('-', '- ').split() + x[1:]
-                y = x + ["=="] + [v]
-                x = [i for i in y if i.isdigit()]
-                self.xs.append(' '.join(x))
-                self.ys.append(' '.join(y))
+        # given a left side and its value
+        x = x[0].replace('-', '- ').split() + x[1:]
+        y = x + ["=="] + [v]
+        x = [i for i in y if i.isdigit()]
+        return ' '.join(x), ' '.join(y)
 
-    def generate(self, L, D):
+    def gen_equation_list(self):
+        # given the equation store
+        for v, x in self.store.gen_operations():
+            x, y = self.gen_equation(v, x)
+            self.xs.append(x)
+            self.ys.append(y)
+
+    def generate(self, L, D, batch_size=0, workers=1, seed=None, sampler='rejection', verify=False):
         # input sequences, output sequences
         self.xs, self.ys = [], []
-        # initialize a value dictionary
+        # initialize an equation store
         # to save the value of each left side
-        self.value_dict = self.gen_base_dict()
+        self.store = self.gen_store(L, verify)
         # generate the left side of an equation
         self.gen_operation_list(
             L=L, 
-            D=D)
-        # generate relations given the value dict
+            D=D, 
+            batch_size=batch_size, 
+            workers=workers, 
+            seed=seed, 
+            sampler=sampler)
+        # generate relations given the equation store
         self.gen_equation_list()
         
         return self.xs, self.ys
 
+    def stream(self, L, D, batch_size=0, workers=1, seed=None, sampler='rejection', verify=False):
+        # input and output sequences one pair at a time in a random order
+        self.store = self.gen_store(L, verify)
+        self.gen_operation_list(
+            L=L, 
+            D=D, 
+            batch_size=batch_size, 
+            workers=workers, 
+            seed=seed, 
+            sampler=sampler)
+        for v, x in self.store.gen_operations(shuffle=True):
+            yield self.gen_equation(v, x)
+
 def train_test_split(xs, ys): 
     # train val test split
     dataset = np.array([(x, y) for x, y in zip(xs, ys)])
@@ -111,7 +119,7 @@ def train_test_split(xs, ys):
 
     return trainset, valset, testset
 
-def save_dataset(trainset, valset, testset, args): 
+def get_outdir(args): 
     outdir = 'aor' 
     outdir = os.path.join(
         outdir, 
@@ -122,13 +130,11 @@ def save_dataset(trainset, valset, testset, args):
     if not os.path.exists(outdir): 
         os.makedirs(outdir)
 
-    save_txt(os.path.join(outdir, 'train_x.txt'), trainset[:, 0])
-    save_txt(os.path.join(outdir, 'train_y.txt'), trainset[:, 1])
-    save_txt(os.path.join(outdir, 'val_x.txt'), valset[:, 0])
-    save_txt(os.path.join(outdir, 'val_y.txt'), valset[:, 1])
-    save_txt(os.path.join(outdir, 'test_x.txt'), testset[:, 0])
-    save_txt(os.path.join(outdir, 'test_y.txt'), testset[:, 1])
+    return outdir
 
+def save_dataset(trainset, valset, testset, args, vocab=None): 
+    outdir = get_outdir(args)
+    save_dataset_splits(outdir, trainset, valset, testset, vocab)
     print("find output from", outdir)
 
 def main():
@@ -148,15 +154,65 @@ def main():
         type=int, 
         required=True, 
         help='defines the number of unique equations')
+    parser.add_argument('--batch_size', 
+        type=int, 
+        default=4096, 
+        help='defines the number of candidates drawn at once, 0 to draw one by one')
+    parser.add_argument('--workers', 
+        type=int, 
+        default=1, 
+        help='defines the number of processes to generate equations')
+    parser.add_argument('--seed', 
+        type=int, 
+        default=None, 
+        help='defines the random seed for reproducible generation')
+    parser.add_argument('--sampler', 
+        type=str, 
+        default='rejection', 
+        choices=['rejection', 'enumeration'], 
+        help='defines how to sample equations, enumeration for small N and L')
+    parser.add_argument('--verify', 
+        action='store_true', 
+        help='compares equations on hash collisions instead of trusting 64-bit hashes')
+    parser.add_argument('--format', 
+        type=str, 
+        default='txt', 
+        choices=['txt', 'npy'], 
+        help='defines the output format, npy for int16 token ids with offsets and a vocab')
+    parser.add_argument('--stream', 
+        action='store_true', 
+        help='writes each equation to its split file as it is generated to keep memory flat')
     args = parser.parse_args()
+    if args.seed is not None: 
+        np.random.seed(args.seed)
     # data generation 
     operators = ['+', '-', '*', '/']
     moi = ArithmeticOperatorRestoration(operators, args.N) 
-    xs, ys = moi.generate(
-        L=args.L-1, 
-        D=args.D)
-    trainset, valset, testset = train_test_split(xs, ys)
-    save_dataset(trainset, valset, testset, args)
+    vocab = moi.gen_vocab() if args.format == 'npy' else None
+    if args.stream: 
+        pairs = moi.stream(
+            L=args.L-1, 
+            D=args.D, 
+            batch_size=args.batch_size, 
+            workers=args.workers, 
+            seed=args.seed, 
+            sampler=args.sampler, 
+            verify=args.verify)
+        outdir = get_outdir(args)
+        stream_dataset(pairs, args.D, outdir, vocab)
+        print("find output from", outdir)
+    else: 
+        xs, ys = moi.generate(
+            L=args.L-1, 
+            D=args.D, 
+            batch_size=args.batch_size, 
+            workers=args.workers, 
+            seed=args.seed, 
+            sampler=args.sampler, 
+            verify=args.verify)
+        trainset, valset, testset = train_test_split(xs, ys)
+        save_dataset(trainset, valset, testset, args, vocab)
+    print('peak RSS {:.1f} MB'.format(get_peak_rss()))
 
 if __name__ == '__main__': 
     main()
\ No newline at end of file
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+__author__ = 'Shining'
+__email__ = 'mrshininnnnn@gmail.com'
+
+# dependency
+# public
+import os
+import json
+import argparse
+import numpy as np
+import multiprocessing as mp
+# private
+from utils import *
+import aor, aes, aec
+
+
+# the generator class and the module to save datasets of each task
+TASKS = {
+    'aor': (aor.ArithmeticOperatorRestoration, aor), 
+    'aes': (aes.ArithmeticEquationSimplification, aes), 
+    'aec': (aec.ArithmeticEquationCorrection, aec)}
+
+def gen_cell_list(job):
+    # generate the largest D of an (N, L) pair once
+    # smaller D are nested prefixes of a single permutation of it
+    task, N, L, D_list, seed, args = job
+    np.random.seed(seed)
+    generator_cls, module = TASKS[task]
+    generator = generator_cls(['+', '-', '*', '/'], N)
+    xs, ys = generator.generate(
+        L=L-1, 
+        D=max(D_list), 
+        batch_size=args.batch_size, 
+        sampler=args.sampler, 
+        verify=args.verify)
+    vocab = generator.gen_vocab() if args.format == 'npy' else None
+    indices = np.random.permutation(len(xs))
+    cell_list = []
+    for D in sorted(D_list): 
+        outdir = module.get_outdir(argparse.Namespace(N=N, L=L, D=D))
+        stream_dataset(((xs[i], ys[i]) for i in indices[:D]), D, outdir, vocab)
+        cell_list.append({
+            'task': task, 
+            'N': N, 
+            'L': L, 
+            'D': D, 
+            'seed': int(seed), 
+            'format': args.format, 
+            'outdir': outdir})
+    return cell_list
+
+def main():
+    # example
+    # python grid.py --task aor --N 10 20 30 40 50 --L 5 6 7 8 9 --D 10000 20000 30000 40000 50000
+    # parameters
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--task', 
+        type=str, 
+        required=True, 
+        choices=list(TASKS), 
+        help='defines the task to generate datasets for')
+    parser.add_argument('--N', 
+        type=int, 
+        nargs='+', 
+        required=True, 
+        help='defines the numbers of unique integers')
+    parser.add_argument('--L', 
+        type=int, 
+        nargs='+', 
+        required=True, 
+        help='defines the numbers of integers in an equation')
+    parser.add_argument('--D', 
+        type=int, 
+        nargs='+', 
+        required=True, 
+        help='defines the numbers of unique equations')
+    parser.add_argument('--batch_size', 
+        type=int, 
+        default=4096, 
+        help='defines the number of candidates drawn at once, 0 to draw one by one')
+    parser.add_argument('--workers', 
+        type=int, 
+        default=1, 
+        help='defines the number of (N, L) pairs to generate at the same time')
+    parser.add_argument('--seed', 
+        type=int, 
+        default=None, 
+        help='defines the random seed for reproducible generation')
+    parser.add_argument('--sampler', 
+        type=str, 
+        default='rejection', 
+        choices=['rejection', 'enumeration'], 
+        help='defines how to sample equations, enumeration for small N and L')
+    parser.add_argument('--verify', 
+        action='store_true', 
+        help='compares equations on hash collisions instead of trusting 64-bit hashes')
+    parser.add_argument('--format', 
+        type=str, 
+        default='txt', 
+        choices=['txt', 'npy'], 
+        help='defines the output format, npy for int16 token ids with offsets and a vocab')
+    args = parser.parse_args()
+    if args.seed is None: 
+        args.seed = int(np.random.randint(2**31))
+    # each (N, L) pair gets a seed derived from the base seed and the pair
+    job_list = [(args.task, N, L, args.D, np.random.SeedSequence([args.seed, N, L]).generate_state(1)[0], args)
+        for N in args.N for L in args.L]
+    with mp.Pool(args.workers) as pool: 
+        cell_list = sum(pool.map(gen_cell_list, job_list), [])
+    # the manifest lists every dataset produced in this run
+    manifest_path = os.path.join(args.task, 'manifest.json')
+    with open(manifest_path, 'w') as f: 
+        json.dump({'seed': args.seed, 'cells': cell_list}, f, indent=2)
+    print('peak RSS {:.1f} MB'.format(get_peak_rss()))
+    print("find manifest from", manifest_path)
+
+if __name__ == '__main__': 
+    main()
@@ -4,6 +4,19 @@
 __author__ = 'Shining'
 __email__ = 'mrshininnnnn@gmail.com'
 
+# dependency
+# public
+import os
+import random
+import hashlib
+import shutil
+import numpy as np
+import multiprocessing as mp
+from tqdm import tqdm
+from fractions import Fraction
+from functools import lru_cache
+
+
 # helper functions
 def save_txt(path: str, line_list:list) -> None:
     with open(path, 'w', encoding='utf-8') as f: 
@@ -11,6 +24,636 @@ def save_txt(path: str, line_list:list) -> None:
             f.write(line + '\n') 
     f.close()
 
+def save_tokens(path: str, line_list: list, vocab: list) -> None:
+    writer = TokenWriter(path, vocab)
+    for line in line_list: 
+        writer.write(line)
+    writer.close()
+
+def save_dataset_splits(outdir: str, trainset, valset, testset, vocab: list = None) -> None:
+    # x and y of each split as text or as token ids given a vocab
+    if vocab is not None: 
+        # token ids and offsets per split with a shared vocab
+        save_txt(os.path.join(outdir, 'vocab.txt'), vocab)
+    for name, dataset in zip(['train', 'val', 'test'], [trainset, valset, testset]): 
+        for i, side in enumerate(['x', 'y']): 
+            if vocab is None: 
+                save_txt(os.path.join(outdir, '{}_{}.txt'.format(name, side)), dataset[:, i])
+            else: 
+                save_tokens(os.path.join(outdir, '{}_{}'.format(name, side)), dataset[:, i], vocab)
+
+def stream_dataset(pairs, data_size: int, outdir: str, vocab: list = None, buffer_size: int = 2**20) -> None:
+    # train val test split without holding the dataset in memory
+    # the split of each pair is given by a permuted index
+    # and each pair is written to its split as soon as it arrives
+    # as text or as token ids given a vocab
+    train_size = int(0.7*data_size)
+    val_size = int(0.15*data_size)
+    test_size = data_size - train_size - val_size
+    splits = np.empty(data_size, dtype=np.int8)
+    indices = np.random.permutation(data_size)
+    splits[indices[:train_size]] = 0
+    splits[indices[train_size: train_size+val_size]] = 1
+    splits[indices[train_size+val_size:]] = 2
+    if vocab is None:
+        files = [[open(os.path.join(outdir, '{}_{}.txt'.format(split, side)), 'w', 
+            encoding='utf-8', buffering=buffer_size) for side in ['x', 'y']] for split in ['train', 'val', 'test']]
+    else:
+        save_txt(os.path.join(outdir, 'vocab.txt'), vocab)
+        files = [[TokenWriter(os.path.join(outdir, '{}_{}'.format(split, side)), vocab) 
+            for side in ['x', 'y']] for split in ['train', 'val', 'test']]
+    try:
+        for (x, y), split in zip(pairs, splits):
+            f_x, f_y = files[split]
+            f_x.write(x + '\n')
+            f_y.write(y + '\n')
+    finally:
+        for f in sum(files, []):
+            f.close()
+    print('train size', train_size)
+    print('val size', val_size)
+    print('test size', test_size)
+
 def convert_to_str(seq:list) -> str:
     seq = [str(number) for number in seq]
-    return ' '.join(seq) 
\ No newline at end of file
+    return ' '.join(seq) 
+
+def get_peak_rss() -> float:
+    # peak resident set size in MB of this process and its finished children
+    # linux reports kilobytes
+    # resource is unix only, so it is imported here to keep utils importable elsewhere
+    import resource
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return rss / 1024
+
+# cached aes base dict
+CACHE_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache')
+
+def build_base_arrays(digits: list, pos_digits: list, operators: list) -> dict:
+    # evaluate every (a, o, b) at once in the order of the nested loops over a, o, b
+    # true division used to give a float key such as '2.0'
+    # so quotients never enter the base dict
+    codes = [i for i, o in enumerate(operators) if o in ['+', '-', '*']]
+    a, o, b = [x.ravel() for x in np.meshgrid(digits, codes, pos_digits, indexing='ij')]
+    symbols = np.array(operators)[o]
+    v = np.select([symbols == '+', symbols == '-'], [a + b, a - b], a * b)
+    keep = np.flatnonzero(np.isin(v, pos_digits))
+    # grouped by value with the loop order kept within each value
+    keep = keep[np.argsort(v[keep], kind='stable')]
+    return {'a': a[keep].astype(np.int16), 'o': o[keep].astype(np.int8), 
+        'b': b[keep].astype(np.int16), 'v': v[keep].astype(np.int16)}
+
+def load_base_dict(digits: list, pos_digits: list, operators: list, cache_path: str = CACHE_PATH) -> dict:
+    # the value to sub-expressions map keyed by N and operators
+    # built once and then loaded from a compact npz file
+    key = hashlib.md5(' '.join(operators).encode('utf-8')).hexdigest()[:8]
+    path = os.path.join(cache_path, 'aes_base_dict_{}N_{}.npz'.format(len(pos_digits), key))
+    if os.path.exists(path):
+        with np.load(path) as f:
+            arrays = {k: f[k] for k in ['a', 'o', 'b', 'v']}
+    else:
+        arrays = build_base_arrays(digits, pos_digits, operators)
+        if not os.path.exists(cache_path): 
+            os.makedirs(cache_path, exist_ok=True)
+        # concurrent builders never leave a partial file behind
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+    base_dict = {str(i):[] for i in pos_digits}
+    for a, o, b, v in zip(*[arrays[k].tolist() for k in ['a', 'o', 'b', 'v']]):
+        base_dict[str(v)].append('( {} {} {} )'.format(str(a).replace('-', '- '), operators[o], b))
+    return base_dict
+
+# binary token-id datasets
+def gen_vocab(operators: list, pos_digits: list) -> list:
+    # one vocab shared by the inputs and outputs of a task
+    # the operators come first as in the source vocab of the pre-processing
+    return ['<pad>'] + operators + ['==', '(', ')'] + [str(i) for i in pos_digits]
+
+def raw_to_npy(raw_path: str, path: str, dtype, size: int) -> None:
+    # put a npy header in front of a raw array file without loading it
+    with open(path, 'wb') as f:
+        np.lib.format.write_array_header_1_0(f, {
+            'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 
+            'fortran_order': False, 
+            'shape': (size, )})
+        with open(raw_path, 'rb') as raw:
+            shutil.copyfileobj(raw, f, 2**20)
+    os.remove(raw_path)
+
+class TokenWriter(): 
+    """docstring for TokenWriter"""
+    # token ids of all sequences in one int16 array
+    # the ids of the i-th sequence are tokens[offsets[i]:offsets[i+1]]
+    def __init__(self, path, vocab, buffer_size=2**16):
+        super().__init__()
+        if len(vocab) > np.iinfo(np.int16).max:
+            raise ValueError('vocab size {} does not fit int16'.format(len(vocab)))
+        self.path = path
+        self.vocab2idx = {token: i for i, token in enumerate(vocab)}
+        self.buffer_size = buffer_size
+        # raw files are turned into npy files once their sizes are known
+        self.tokens_file = open(path + '.tokens.tmp', 'wb')
+        self.offsets_file = open(path + '.offsets.tmp', 'wb')
+        self.tokens, self.offsets = [], [0]
+        self.num_tokens, self.num_offsets = 0, 0
+
+    def write(self, line):
+        self.tokens += [self.vocab2idx[token] for token in line.split()]
+        self.offsets.append(self.num_tokens + len(self.tokens))
+        if len(self.offsets) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        np.array(self.tokens, dtype=np.int16).tofile(self.tokens_file)
+        np.array(self.offsets, dtype=np.int64).tofile(self.offsets_file)
+        self.num_tokens += len(self.tokens)
+        self.num_offsets += len(self.offsets)
+        self.tokens, self.offsets = [], []
+
+    def close(self):
+        self.flush()
+        self.tokens_file.close()
+        self.offsets_file.close()
+        raw_to_npy(self.path + '.tokens.tmp', self.path + '.npy', np.int16, self.num_tokens)
+        raw_to_npy(self.path + '.offsets.tmp', self.path + '_offsets.npy', np.int64, self.num_offsets)
+
+# batched corruption
+def gen_chunks(items, size: int = 2**12):
+    # group an iterable into lists of at most size items
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def encode_batch(lines: list, vocab: list) -> tuple:
+    # white space tokenized lines to a matrix of token ids padded with 0
+    vocab2idx = {token: i for i, token in enumerate(vocab)}
+    seqs = [[vocab2idx[token] for token in line.split()] for line in lines]
+    lens = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    ids = np.zeros((len(seqs), lens.max() if len(seqs) > 0 else 0), dtype=np.int64)
+    for i, seq in enumerate(seqs):
+        ids[i, :len(seq)] = seq
+    return ids, lens
+
+def decode_batch(ids: np.ndarray, symbols: list) -> list:
+    # a matrix of symbol ids back to lines with the padding 0 dropped
+    symbols = np.array(symbols, dtype=object)
+    return [' '.join(symbols[row[row > 0]]) for row in ids]
+
+def sample_positions(mask: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    # draw counts[i] distinct positions uniformly among the true entries of each row
+    # the unused positions are -1
+    keys = np.where(mask, np.random.random(mask.shape), 2.)
+    k = int(counts.max()) if counts.size > 0 else 0
+    positions = np.argsort(keys, axis=1)[:, :k]
+    return np.where(np.arange(k)[None, :] < counts[:, None], positions, -1)
+
+def corrupt_batch(ids: np.ndarray, lens: np.ndarray, num_errors: int, choices: np.ndarray) -> np.ndarray:
+    # up to num_errors edits on each row as random_transform in aec
+    # the number of edits, their positions, kinds, and tokens are drawn for all rows at once
+    # the last token is never edited
+    B, W = ids.shape
+    counts = np.random.randint(num_errors+1, size=B)
+    if (counts > lens - 1).any():
+        raise ValueError('an equation is shorter than the number of errors')
+    positions = sample_positions(np.arange(W)[None, :] < (lens - 1)[:, None], counts)
+    # delete, insert, sub
+    kinds = np.random.randint(3, size=positions.shape)
+    tokens = choices[np.random.randint(len(choices), size=positions.shape)]
+    # each position has a slot for an inserted token in front of it
+    out = np.zeros((B, W, 2), dtype=ids.dtype)
+    out[:, :, 1] = ids
+    r, k = np.nonzero(positions >= 0)
+    c, kind, token = positions[r, k], kinds[r, k], tokens[r, k]
+    out[r[kind == 0], c[kind == 0], 1] = 0
+    out[r[kind == 1], c[kind == 1], 0] = token[kind == 1]
+    out[r[kind == 2], c[kind == 2], 1] = token[kind == 2]
+    return out.reshape(B, 2*W)
+
+def gen_sub_table(vocab: list, base_dict: dict) -> tuple:
+    # symbols are the vocab followed by all sub-expressions
+    # the sub-expressions of the token with id i are symbols[start[i]:start[i]+count[i]]
+    symbols = list(vocab)
+    start = np.zeros(len(vocab), dtype=np.int64)
+    count = np.zeros(len(vocab), dtype=np.int64)
+    for i, token in enumerate(vocab):
+        if token in base_dict:
+            start[i], count[i] = len(symbols), len(base_dict[token])
+            symbols += base_dict[token]
+    return symbols, start, count
+
+def replace_batch(ids: np.ndarray, symbols: list, start: np.ndarray, count: np.ndarray) -> np.ndarray:
+    # replace some integers of each row by sub-expressions as replace_numbers in aes
+    # the number of replacements is uniform up to the number of integers in the row
+    numbers = np.array([symbol.isdigit() for symbol in symbols])[ids]
+    counts = np.floor(np.random.random(ids.shape[0]) * (numbers.sum(axis=1) + 1)).astype(np.int64)
+    positions = sample_positions(numbers, counts)
+    r, k = np.nonzero(positions >= 0)
+    c = positions[r, k]
+    token = ids[r, c]
+    if (count[token] == 0).any():
+        raise ValueError('no sub-expression for {}'.format(symbols[token[count[token] == 0][0]]))
+    out = ids.copy()
+    out[r, c] = start[token] + np.floor(np.random.random(token.size) * count[token]).astype(np.int64)
+    return out
+
+# compact equation storage
+def encode_operation(operation: list, operators: list) -> tuple:
+    # convert a token list from gen_operation to integers and operator indexes
+    return [int(b) for b in operation[::2]], [operators.index(o) for o in operation[1::2]]
+
+def hash_rows(rows: np.ndarray) -> np.ndarray:
+    # 64-bit FNV-1a over the columns followed by the splitmix64 finalizer
+    # 0 marks an empty slot, so it is never returned
+    h = np.full(rows.shape[0], 0xcbf29ce484222325, dtype=np.uint64)
+    for k in range(rows.shape[1]):
+        h = (h ^ rows[:, k].astype(np.uint64)) * np.uint64(0x100000001b3)
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    h = h ^ (h >> np.uint64(31))
+    h[h == 0] = 1
+    return h
+
+class EquationStore(): 
+    """docstring for EquationStore"""
+    def __init__(self, operators, values, L, verify=False, capacity=1024):
+        super().__init__()
+        self.operators = operators
+        self.values = values
+        self.L = L
+        # compare the stored rows when two hashes are equal
+        self.verify = verify
+        self.size = 0
+        # left sides as integers and operator indexes with their values
+        self.nums = np.empty((capacity, L), dtype=np.int16)
+        self.ops = np.empty((capacity, L-1), dtype=np.int8)
+        self.vals = np.empty(capacity, dtype=np.int16)
+        # open addressing table of 64-bit hashes at most half full
+        self.keys = np.zeros(2*capacity, dtype=np.uint64)
+        # the row of each slot is only kept for verification
+        self.rows = np.full(2*capacity, -1, dtype=np.int64) if verify else None
+
+    def __len__(self):
+        return self.size
+
+    def get_rows(self, idxes):
+        return np.concatenate([self.nums[idxes], self.ops[idxes]], axis=1).astype(np.int64)
+
+    def probe(self, hashes, idxes, check):
+        # claim a slot for each hash in order by linear probing
+        # returns the claimed slot of each hash or -1 for a duplicate
+        mask = np.uint64(self.keys.size - 1)
+        slots = np.full(hashes.size, -1, dtype=np.int64)
+        todo = np.arange(hashes.size)
+        slot = (hashes & mask).astype(np.int64)
+        while todo.size > 0:
+            k = self.keys[slot]
+            dup = (k == hashes[todo]) if check else np.zeros(todo.size, dtype=bool)
+            if self.verify and dup.any():
+                # equal hashes of different rows are collisions
+                same = np.all(self.get_rows(self.rows[slot[dup]]) == self.get_rows(idxes[todo[dup]]), axis=1)
+                dup[np.flatnonzero(dup)[~same]] = False
+            # the first of several hashes on the same empty slot wins
+            empty = np.flatnonzero(k == 0)
+            _, win = np.unique(slot[empty], return_index=True)
+            win = empty[win]
+            self.keys[slot[win]] = hashes[todo[win]]
+            if self.verify:
+                self.rows[slot[win]] = idxes[todo[win]]
+            slots[todo[win]] = slot[win]
+            # losers look at the same slot again, the others move on
+            done = dup.copy()
+            done[win] = True
+            move = (k != 0) & ~dup
+            slot[move] = (slot[move] + 1) & int(mask)
+            todo, slot = todo[~done], slot[~done]
+        return slots
+
+    def reserve(self, size):
+        # grow the storage and rebuild the table when it gets half full
+        if size > self.vals.size:
+            capacity = max(size, 2*self.vals.size)
+            for name in ['nums', 'ops', 'vals']:
+                old = getattr(self, name)
+                new = np.empty((capacity, ) + old.shape[1:], dtype=old.dtype)
+                new[:self.size] = old[:self.size]
+                setattr(self, name, new)
+        if 2*size > self.keys.size:
+            keys = self.keys[self.keys != 0]
+            rows = self.rows[self.keys != 0] if self.verify else None
+            table_size = self.keys.size
+            while 2*size > table_size:
+                table_size *= 2
+            self.keys = np.zeros(table_size, dtype=np.uint64)
+            if self.verify:
+                self.rows = np.full(table_size, -1, dtype=np.int64)
+            self.probe(keys, rows, False)
+
+    def insert(self, nums, ops, vals):
+        # add a batch of equations and return the mask of the new ones
+        rows = np.concatenate([nums, ops], axis=1).astype(np.int64)
+        hashes = hash_rows(rows)
+        # the first of identical rows in the batch
+        _, first = np.unique(rows if self.verify else hashes, axis=0, return_index=True)
+        first = np.sort(first)
+        self.reserve(self.size + first.size)
+        # candidates are staged after the stored rows
+        stage = np.arange(self.size, self.size + first.size)
+        self.nums[stage], self.ops[stage], self.vals[stage] = nums[first], ops[first], vals[first]
+        slots = self.probe(hashes[first], stage, True)
+        new = slots >= 0
+        # the new rows are packed in order
+        packed = np.arange(self.size, self.size + new.sum())
+        self.nums[packed], self.ops[packed], self.vals[packed] = \
+            self.nums[stage[new]], self.ops[stage[new]], self.vals[stage[new]]
+        if self.verify:
+            self.rows[slots[new]] = packed
+        self.size += packed.size
+        mask = np.zeros(rows.shape[0], dtype=bool)
+        mask[first[new]] = True
+        return mask
+
+    def add(self, nums, ops, vals, limit=None):
+        # add at most limit new equations in order and return the mask of the new ones
+        nums = np.asarray(nums).reshape(-1, self.L)
+        # by rows, since -1 is ambiguous without operators
+        ops, vals = np.asarray(ops).reshape(len(nums), self.L-1), np.asarray(vals).reshape(-1)
+        mask = np.zeros(vals.size, dtype=bool)
+        i = 0
+        while i < vals.size and (limit is None or mask.sum() < limit):
+            j = vals.size if limit is None else i + limit - mask.sum()
+            mask[i:j] = self.insert(nums[i:j], ops[i:j], vals[i:j])
+            i = j
+        return mask
+
+    def add_operation(self, operation, value):
+        # add a single token list and tell whether it is new
+        nums, ops = encode_operation(operation, self.operators)
+        return bool(self.add(nums, ops, [value])[0])
+
+    def gen_operations(self, shuffle=False):
+        # the stored left sides grouped by value in the order of values
+        # the insertion order is kept within each value as in the value dict
+        # or all of them in a random order
+        if shuffle:
+            order = np.random.permutation(self.size)
+        else:
+            rank = np.zeros(max(self.values)+1, dtype=np.int64)
+            rank[self.values] = np.arange(len(self.values))
+            order = np.argsort(rank[self.vals[:self.size]], kind='stable')
+        for i in order:
+            yield str(self.vals[i]), decode_operation(self.nums[i], self.ops[i], self.operators)
+
+# safe arithmetic evaluation
+# integers with + - * / ( ) only, evaluated as exact rationals
+def eval_factor(tokens: tuple, i: int) -> tuple:
+    if i >= len(tokens):
+        raise ValueError('incomplete expression')
+    token = tokens[i]
+    if token in ['+', '-']:
+        # unary sign
+        value, i = eval_factor(tokens, i+1)
+        return (-value if token == '-' else value), i
+    if token == '(':
+        depth = 0
+        for j in range(i, len(tokens)):
+            depth += (tokens[j] == '(') - (tokens[j] == ')')
+            if depth == 0:
+                return eval_expression(tokens[i+1:j]), j+1
+        raise ValueError('unbalanced parentheses')
+    return Fraction(int(token)), i+1
+
+@lru_cache(maxsize=2**16)
+def eval_term(term: tuple) -> Fraction:
+    # a chain of multiplications and divisions
+    # cached since the same sub-expressions repeat across equations
+    value, i = eval_factor(term, 0)
+    while i < len(term):
+        o = term[i]
+        if o not in ['*', '/']:
+            raise ValueError('unexpected token {}'.format(o))
+        b, i = eval_factor(term, i+1)
+        value = value * b if o == '*' else value / b
+    return value
+
+def eval_expression(tokens: tuple) -> Fraction:
+    # split the top level into terms joined by binary + and -
+    value, sign, start, depth = Fraction(0), 1, 0, 0
+    for i, token in enumerate(tokens):
+        depth += (token == '(') - (token == ')')
+        if depth == 0 and token in ['+', '-'] and i > start and tokens[i-1] not in ['+', '-', '*', '/', '(']:
+            value += sign * eval_term(tokens[start:i])
+            sign, start = (-1 if token == '-' else 1), i+1
+    return value + sign * eval_term(tokens[start:])
+
+def eval_tokens(tokens: list):
+    # evaluate a token list such as ['-5', '+', '3', '*', '2']
+    # return None for anything that is not a valid expression
+    try:
+        return eval_expression(tuple(tokens))
+    except (ValueError, ZeroDivisionError):
+        return None
+
+def eval_tokens_batch(token_lists: list) -> list:
+    return [eval_tokens(tokens) for tokens in token_lists]
+
+# batch generation
+def gen_operation_batch(digits: list, pos_digits: list, operators: list, L: int, B: int) -> tuple:
+    # draw the left sides of B equations at once
+    # the first integer can be negative while the rest are positive
+    nums = np.empty((B, L), dtype=np.int64)
+    nums[:, 0] = np.random.choice(digits, B)
+    nums[:, 1:] = np.random.choice(pos_digits, (B, L-1))
+    # operators are saved as indexes of the operator list
+    ops = np.random.randint(len(operators), size=(B, L-1))
+    return nums, ops
+
+def eval_operation_batch(nums: np.ndarray, ops: np.ndarray, operators: list) -> np.ndarray:
+    # evaluate the left sides of B equations at once
+    # multiplication and division bind to the current term
+    # addition and subtraction flush the term into the accumulator
+    # float operations follow the same order as python eval
+    codes = np.array([operators.index(o) if o in operators else -1 for o in ['+', '-', '*', '/']])
+    nums = nums.astype(np.float64)
+    acc = np.zeros(nums.shape[0])
+    sign = np.ones(nums.shape[0])
+    term = nums[:, 0].copy()
+    for k in range(ops.shape[1]):
+        o, b = ops[:, k], nums[:, k+1]
+        is_mul, is_div = o == codes[2], o == codes[3]
+        is_new = ~(is_mul | is_div)
+        # close the current term
+        acc = np.where(is_new, np.where(sign > 0, acc + term, acc - term), acc)
+        sign = np.where(is_new, np.where(o == codes[1], -1., 1.), sign)
+        term = np.where(is_mul, term * b, np.where(is_div, term / b, np.where(is_new, b, term)))
+    return np.where(sign > 0, acc + term, acc - term)
+
+def decode_operation(nums: np.ndarray, ops: np.ndarray, operators: list) -> list:
+    # convert a row back to the token list used by gen_operation
+    operation = [str(nums[0])]
+    for o, b in zip(ops, nums[1:]):
+        operation += [operators[o], str(b)]
+    return operation
+
+def batch_gen_operation_list(store: EquationStore, digits: list, pos_digits: list,
+    operators: list, L: int, D: int, batch_size: int) -> None:
+    # rejection sampling over whole batches of candidates
+    # the store is filled in place as the value dict in gen_operation_list
+    pbar = tqdm(total=D)
+    while len(store) < D:
+        nums, ops = gen_operation_batch(digits, pos_digits, operators, L, batch_size)
+        values = eval_operation_batch(nums, ops, operators)
+        # float values pre-filter integers in the vocab range
+        valid = np.flatnonzero((np.abs(values - np.round(values)) < 1e-6) & np.isin(np.round(values), pos_digits))
+        # exact rational values confirm the candidates
+        exact = eval_tokens_batch([decode_operation(nums[i], ops[i], operators) for i in valid])
+        keep = [k for k, v in enumerate(exact) if v.denominator == 1 and v.numerator in store.values]
+        size = len(store)
+        store.add(nums[valid[keep]], ops[valid[keep]], [exact[k].numerator for k in keep], D - size)
+        pbar.update(len(store) - size)
+    pbar.close()
+
+# parallel generation
+def gen_operation_shard(shard: tuple) -> EquationStore:
+    # generate one shard of left sides in a worker process
+    generator_cls, operators, N, L, D, seed, batch_size, verify = shard
+    np.random.seed(seed)
+    generator = generator_cls(operators, N)
+    generator.store = generator.gen_store(L, verify)
+    generator.gen_operation_list(L, D, batch_size)
+    return generator.store
+
+def parallel_gen_operation_list(store: EquationStore, generator_cls, operators: list, N: int, 
+    L: int, D: int, batch_size: int, workers: int, seed: int) -> None:
+    # split D across a process pool and merge the shards in order
+    # each shard gets a seed derived from the base seed, the round, and the shard id
+    if seed is None:
+        seed = int(np.random.randint(2**31))
+    num_round = 0
+    with mp.Pool(workers) as pool:
+        while len(store) < D:
+            # shards may overlap, so the deficit is generated again in a new round
+            remain = D - len(store)
+            sizes = [remain//workers + int(i < remain%workers) for i in range(workers)]
+            seeds = [s.generate_state(1)[0] for s in np.random.SeedSequence([seed, num_round]).spawn(workers)]
+            shards = [(generator_cls, operators, N, L, d, s, batch_size, store.verify) 
+                for d, s in zip(sizes, seeds) if d > 0]
+            for shard in pool.map(gen_operation_shard, shards):
+                # duplicates across shards are dropped by the store
+                n = len(shard)
+                store.add(shard.nums[:n], shard.ops[:n], shard.vals[:n])
+            num_round += 1
+
+# exhaustive enumeration
+def next_state(state: tuple, o: str, b) -> tuple:
+    # a prefix state holds the sum of closed terms and the signed current term
+    acc, term = state
+    if o == '*':
+        return acc, term * b
+    if o == '/':
+        return acc, term / b
+    return acc + term, (b if o == '+' else -b)
+
+def count_operation_list(digits: list, pos_digits: list, operators: list, L: int, values: list) -> tuple:
+    # dynamic programming over prefix values
+    # counts[k][state] is the number of ways to complete a prefix of k+1 integers
+    # to a left side whose value is in values
+    choices = [(o, Fraction(b)) for o in operators for b in pos_digits]
+    targets = set(Fraction(v) for v in values)
+    levels = [set((Fraction(0), Fraction(a)) for a in digits)]
+    for k in range(1, L-1):
+        levels.append(set(next_state(s, o, b) for s in levels[-1] for o, b in choices))
+    counts = [None] * len(levels)
+    for k in range(len(levels)-1, -1, -1):
+        if k == L-1:
+            # a single integer
+            counts[k] = {s: int(sum(s) in targets) for s in levels[k]}
+        elif k == L-2:
+            # the last step is counted without building the last level
+            counts[k] = {s: sum(sum(next_state(s, o, b)) in targets for o, b in choices) for s in levels[k]}
+        else:
+            counts[k] = {s: sum(counts[k+1].get(next_state(s, o, b), 0) for o, b in choices) for s in levels[k]}
+        # prefixes without any valid completion are never visited again
+        counts[k] = {s: c for s, c in counts[k].items() if c > 0}
+    total = sum(counts[0].values())
+    return counts, total
+
+def unrank_operation(counts: list, digits: list, pos_digits: list, operators: list, 
+    L: int, values: list, r: int) -> tuple:
+    # map an index in [0, total) to its left side in lexicographic order
+    choices = [(o, b) for o in operators for b in pos_digits]
+    targets = set(Fraction(v) for v in values)
+    for a in digits:
+        state = (Fraction(0), Fraction(a))
+        c = counts[0].get(state, 0)
+        if r < c:
+            break
+        r -= c
+    operation = [str(a)]
+    for k in range(1, L):
+        for o, b in choices:
+            s = next_state(state, o, Fraction(b))
+            if k == L-1:
+                c = int(sum(s) in targets)
+            else:
+                c = counts[k].get(s, 0)
+            if r < c:
+                break
+            r -= c
+        state = s
+        operation += [o, str(b)]
+    return operation, sum(state)
+
+def enum_gen_operation_list(store: EquationStore, digits: list, pos_digits: list, 
+    operators: list, L: int, D: int) -> None:
+    # sample D valid left sides uniformly without replacement
+    values = store.values
+    counts, total = count_operation_list(digits, pos_digits, operators, L, values)
+    print('valid left sides', total)
+    if D > total:
+        raise ValueError('D={} is infeasible, there are only {} unique equations'.format(D, total))
+    # python random handles populations beyond int64
+    rng = random.Random(int(np.random.randint(2**31)))
+    nums, ops, vals = [], [], []
+    for r in tqdm(rng.sample(range(total), D)):
+        operation, value = unrank_operation(counts, digits, pos_digits, operators, L, values, r)
+        num, op = encode_operation(operation, operators)
+        nums.append(num)
+        ops.append(op)
+        vals.append(value.numerator)
+    store.add(nums, ops, vals)
+
+# sampler dispatch
+def sample_operation_list(generator, digits: list, pos_digits: list, L: int, D: int, 
+    batch_size: int = 0, workers: int = 1, seed: int = None, sampler: str = 'rejection') -> None:
+    # fill the store of a generator with D unique left sides
+    store, operators = generator.store, generator.operators
+    if sampler == 'enumeration': 
+        # exact counting and sampling without replacement
+        return enum_gen_operation_list(store, digits, pos_digits, operators, L, D)
+    if workers > 1: 
+        # sharded sampling over a process pool
+        return parallel_gen_operation_list(store, type(generator), operators, 
+            generator.N, L, D, batch_size, workers, seed)
+    if batch_size > 0: 
+        # vectorized sampling over batches of candidates
+        return batch_gen_operation_list(store, digits, pos_digits, operators, L, D, batch_size)
+    # to control the data size
+    for i in tqdm(range(D)):
+        while True: 
+            operation = generator.gen_operation(L) 
+            # exact rational value, None if not a valid expression
+            value = eval_tokens(operation)
+            if value is None or value.denominator != 1: 
+                continue
+            # to keep vocab size
+            # and to avoid duplicates
+            if value.numerator in store.values and store.add_operation(operation, value.numerator): 
+                break
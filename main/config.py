@@ -25,6 +25,8 @@ class Config():
         self.L = 5 # input sequence length
         self.D = 10000 # total data size
         self.num_errors = 3 #  the numebr of errors for AEC
+        self.editops_cache_size = 2**16 # the max number of (x, y) pairs in the AEC editops cache
+        self.seed = 0 # the base seed of the random streams of online generation and batching
         # I/O directory
         # current path
         self.CURR_PATH = os.path.dirname(os.path.realpath(__file__))
@@ -34,9 +36,14 @@ class Config():
         # data dictionary in json file
         self.DATA_PATH = os.path.join(self.CURR_PATH, 'res/data/', 
             self.data_src, self.method, self.TASK_PATH, 'data.json')
+        # memory-mapped token store converted from the data dictionary
+        self.STORE_PATH = os.path.join(self.CURR_PATH, 'res/data/', 
+            self.data_src, self.method, self.TASK_PATH, 'store')
         # vocab dictionary in json file
         self.VOCAB_PATH = os.path.join(self.CURR_PATH, 'res/data/', 
             self.data_src, self.method, self.TASK_PATH, 'vocab.json')
+        # path to cache the aes base dict
+        self.CACHE_PATH = os.path.join(self.CURR_PATH, 'res/cache/')
         # path to save and load check point
         self.SAVE_PATH = os.path.join(self.CURR_PATH, 'res/check_points/', 
             self.data_src, self.data_mode, self.method, self.TASK_PATH)
@@ -65,6 +72,11 @@ class Config():
         self.num_workers = 2
         self.pin_memory = True
         self.drop_last = True
+        self.bucketing = False # batch training samples of similar lengths together
+        self.eval_bucketing = False # also for val and test, which reorders the saved results
+        self.max_tokens = None # the max number of padded input tokens per bucketed batch instead of batch_size
+        self.num_producers = 0 # processes generating online training batches ahead instead of data loader workers, 0 to disable
+        self.producer_depth = 8 # the number of batch slots in the shared-memory ring buffer of the producers
         # val
         self.val_win_size = 512
         # model
@@ -7,11 +7,14 @@ __email__ = 'mrshininnnnn@gmail.com'
 
 # dependency
 # public
+import os
 import json
-import Levenshtein
+import importlib.util
 import numpy as np
 
 
+CURR_PATH = os.path.dirname(os.path.realpath(__file__))
+
 # helper functions
 def load_txt(path: str) -> list:
     with open(path, 'r', encoding='utf-8') as f: 
@@ -24,17 +27,25 @@ def save_json(path: str, data_dict: dict) -> None:
 def white_space_tokenizer(str_seq_list: list) -> list:
     return [str_seq.split(' ') for str_seq in str_seq_list]
 
+def load_editops_utils():
+    # the editops cache of the trainers so that both share one implementation
+    spec = importlib.util.spec_from_file_location('editops', os.path.join(
+        CURR_PATH, os.pardir, os.pardir, os.pardir, 'src', 'utils', 'editops.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+EDITOPS = load_editops_utils()
+
+def init_editops_cache(maxsize: int = 2**16) -> None:
+    # a fresh cache of maxsize pairs extended by unseen tokens
+    EDITOPS.init_editops_cache(maxsize=maxsize)
+
+def editops_cache_info() -> dict:
+    return EDITOPS.editops_cache_info()
+
 def levenshtein_editops_list(source, target):
-    unique_elements = sorted(set(source + target)) 
-    char_list = [chr(i) for i in range(len(unique_elements))]
-    if len(unique_elements) > len(char_list):
-        raise Exception("too many elements")
-    else:
-        unique_element_map = {ele:char_list[i]  for i, ele in enumerate(unique_elements)}
-    source_str = ''.join([unique_element_map[ele] for ele in source])
-    target_str = ''.join([unique_element_map[ele] for ele in target])
-    transform_list = Levenshtein.editops(source_str, target_str)
-    return transform_list
+    return EDITOPS.levenshtein_editops_list(source, target)
 
 def gen_rec_pair(x: list, y: list) -> list:
     # white space tokenization
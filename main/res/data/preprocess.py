@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+__author__ = 'Shining'
+__email__ = 'mrshininnnnn@gmail.com'
+
+
+# dependency
+# public
+import os
+import json
+import hashlib
+import argparse
+import importlib.util
+import numpy as np
+import multiprocessing as mp
+from collections import Counter
+
+
+CURR_PATH = os.path.dirname(os.path.realpath(__file__))
+TASKS = ['aor', 'aes', 'aec']
+METHODS = ['e2e', 'tag', 'rec']
+
+def load_task_utils(task):
+    # each task folder has its own utils with gen_tag_pair and gen_rec_pair
+    spec = importlib.util.spec_from_file_location(
+        '{}_utils'.format(task), os.path.join(CURR_PATH, task, 'utils.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+TASK_UTILS = {task: load_task_utils(task) for task in TASKS}
+
+def load_store_utils():
+    # the token store of the trainers also reads the npy output of the data generators
+    spec = importlib.util.spec_from_file_location(
+        'store', os.path.join(CURR_PATH, os.pardir, os.pardir, 'src', 'utils', 'store.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+STORE = load_store_utils()
+
+# helper functions
+def get_task_path(N, L, D):
+    return os.path.join('{}N'.format(N), '{}L'.format(L), '{}D'.format(D))
+
+def get_indir(task, N, L, D):
+    return os.path.join(CURR_PATH, task, task, get_task_path(N, L, D))
+
+def get_outdir(task, method, N, L, D):
+    return os.path.join(CURR_PATH, task, method, get_task_path(N, L, D))
+
+def load_txt(path: str) -> list:
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read().splitlines()
+
+def save_json(path: str, data_dict: dict) -> None:
+    with open(path, 'w') as f:
+        json.dump(data_dict, f, ensure_ascii=False)
+
+def hash_file(path: str) -> str:
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def white_space_tokenizer(str_seq_list: list) -> list:
+    return [str_seq.split(' ') for str_seq in str_seq_list]
+
+def gen_vocab2idx_dict(seqs: list, special_list: list, extra_list: list = []) -> dict:
+    # special tokens first and then the sorted tokens of seqs
+    counter = Counter()
+    for seq in seqs:
+        counter.update(seq)
+    vocab_list = list(counter.keys())
+    for token in extra_list:
+        if token not in vocab_list:
+            vocab_list.append(token)
+    vocab_list.sort()
+    vocab2idx_dict = dict()
+    for i, token in enumerate(special_list):
+        vocab2idx_dict[token] = i
+    i = len(vocab2idx_dict)
+    for token in vocab_list:
+        vocab2idx_dict[token] = i
+        i += 1
+    return vocab2idx_dict
+
+def get_raw_names(indir):
+    # text splits, or token ids and offsets with a vocab as saved by --format npy
+    if os.path.exists(os.path.join(indir, 'train_x.txt')):
+        return ['{}_{}.txt'.format(split, side) for split in ['train', 'val', 'test'] for side in ['x', 'y']]
+    return ['{}_{}{}'.format(split, side, suffix) for split in ['train', 'val', 'test'] for side in ['x', 'y'] 
+        for suffix in ['.npy', '_offsets.npy']] + ['vocab.txt']
+
+def load_raw(indir, name):
+    # raw lines of a split and side from either format
+    path = os.path.join(indir, name)
+    if os.path.exists(path + '.txt'):
+        return load_txt(path + '.txt')
+    seqs = STORE.load_token_file(path)
+    return [' '.join(seqs[i]) for i in range(len(seqs))]
+
+def load_cell(task, N, L, D):
+    # read each raw split once and tokenize it for all methods
+    indir = get_indir(task, N, L, D)
+    raw_dict, token_dict = dict(), dict()
+    for split in ['train', 'val', 'test']:
+        raw_xs = load_raw(indir, '{}_x'.format(split))
+        raw_ys = load_raw(indir, '{}_y'.format(split))
+        print('{} {} sample size'.format(indir, split), len(raw_xs))
+        print('{} {} label size'.format(indir, split), len(raw_ys))
+        raw_dict[split] = (raw_xs, raw_ys)
+        token_dict[split] = (white_space_tokenizer(raw_xs), white_space_tokenizer(raw_ys))
+    return raw_dict, token_dict
+
+# preprocessing of the train split for each method
+def e2e_preprocess(task, L, raw_xs, raw_ys, xs, ys):
+    train_dict = {'xs': xs, 'ys': ys} if task == 'aor' else {'ys': ys}
+    return train_dict, xs, ys, ['<pad>', '<s>', '</s>']
+
+def tag_preprocess(task, L, raw_xs, raw_ys, xs, ys):
+    utils = TASK_UTILS[task]
+    ys_ = [utils.gen_tag_pair(x, y)[2] for x, y in zip(raw_xs, raw_ys)]
+    if task != 'aec':
+        ys_ = white_space_tokenizer(ys_)
+    train_dict = {'xs': xs, 'ys': ys, 'ys_': ys_} if task == 'aor' else {'ys': ys}
+    return train_dict, xs, ys_, ['<pad>', '<s>', '</s>']
+
+def rec_preprocess(task, L, raw_xs, raw_ys, xs, ys):
+    utils = TASK_UTILS[task]
+    if task == 'aor':
+        xs, ys_, ys = zip(*[utils.gen_rec_pair(y) for y in raw_ys])
+    else:
+        xs, ys_, ys = zip(*[utils.gen_rec_pair(x, y) for x, y in zip(raw_xs, raw_ys)])
+    train_dict = {'xs': xs, 'ys': ys, 'ys_': ys_} if task == 'aor' else {'ys': ys}
+    return train_dict, xs, ys_, ['<pad>', '<s>']
+
+PREPROCESSES = {'e2e': e2e_preprocess, 'tag': tag_preprocess, 'rec': rec_preprocess}
+
+# incremental preprocessing
+# each output folder keeps a manifest of what it was built from
+def gen_input_dict(task, N, L, D):
+    # hashes of the raw splits of a cell and of the code that processes them
+    indir = get_indir(task, N, L, D)
+    input_dict = {name: hash_file(os.path.join(indir, name)) for name in get_raw_names(indir)}
+    input_dict['preprocess.py'] = hash_file(os.path.realpath(__file__))
+    input_dict['utils.py'] = hash_file(os.path.join(CURR_PATH, task, 'utils.py'))
+    return input_dict
+
+def gen_manifest_dict(task, N, L, D, method, seed, input_dict):
+    return {'inputs': input_dict, 
+        'params': {'task': task, 'N': N, 'L': L, 'D': D, 'method': method, 'seed': seed}}
+
+def is_up_to_date(outdir, manifest_dict):
+    # same inputs and parameters, and outputs untouched since they were built
+    manifest_path = os.path.join(outdir, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return False
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        saved_dict = json.load(f)
+    if any(saved_dict.get(k) != v for k, v in manifest_dict.items()):
+        return False
+    return all(os.path.exists(os.path.join(outdir, name)) and hash_file(os.path.join(outdir, name)) == h 
+        for name, h in saved_dict['outputs'].items())
+
+def save_manifest(outdir, manifest_dict):
+    # written last so that an interrupted run leaves the folder stale
+    manifest_dict = dict(manifest_dict, outputs={name: hash_file(os.path.join(outdir, name)) 
+        for name in ['data.json', 'vocab.json']})
+    tmp_path = os.path.join(outdir, 'manifest.json.{}.tmp'.format(os.getpid()))
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest_dict, f, indent=2)
+    os.replace(tmp_path, os.path.join(outdir, 'manifest.json'))
+
+def preprocess(job):
+    # produce data.json and vocab.json of one method for one cell
+    task, N, L, D, method, seed, manifest_dict, raw_dict, token_dict = job
+    np.random.seed(seed)
+    train_dict, src_seqs, tgt_seqs, tgt_special_list = PREPROCESSES[method](
+        task, L, *raw_dict['train'], *token_dict['train'])
+    # the aor source vocab of e2e and tag reserves the operators for online training
+    src_special_list = ['<pad>']
+    if task == 'aor' and method != 'rec':
+        src_special_list += ['+', '-', '*', '/', '==']
+    # every position is a target of aec rec
+    extra_list = ['<pos_{}>'.format(i) for i in range(L*2)] if task == 'aec' and method == 'rec' else []
+    vocab_dict = dict()
+    vocab_dict['src'] = gen_vocab2idx_dict(src_seqs, src_special_list)
+    vocab_dict['tgt'] = gen_vocab2idx_dict(tgt_seqs, tgt_special_list, extra_list)
+    data_dict = dict()
+    data_dict['train'] = train_dict
+    for split in ['val', 'test']:
+        xs, ys = token_dict[split]
+        data_dict[split] = {'xs': xs, 'ys': ys}
+    # save output as json
+    outdir = get_outdir(task, method, N, L, D)
+    if not os.path.exists(outdir):
+        os.makedirs(outdir, exist_ok=True)
+    save_json(os.path.join(outdir, 'data.json'), data_dict)
+    save_json(os.path.join(outdir, 'vocab.json'), vocab_dict)
+    save_manifest(outdir, manifest_dict)
+    if task == 'aec':
+        print('{} editops cache'.format(outdir), TASK_UTILS[task].editops_cache_info())
+    return outdir
+
+def gen_job_list(args, seed):
+    # one job per method and cell whose outputs are stale
+    # all methods of a cell share one read of the raw data
+    for N in args.N:
+        for L in args.L:
+            for D in args.D:
+                input_dict = gen_input_dict(args.task, N, L, D)
+                manifest_dicts = {method: gen_manifest_dict(args.task, N, L, D, method, args.seed, input_dict) 
+                    for method in args.methods}
+                methods = [method for method in args.methods if args.force 
+                    or not is_up_to_date(get_outdir(args.task, method, N, L, D), manifest_dicts[method])]
+                for method in args.methods:
+                    if method not in methods:
+                        print('Up to date {}'.format(get_outdir(args.task, method, N, L, D)))
+                if len(methods) == 0:
+                    continue
+                raw_dict, token_dict = load_cell(args.task, N, L, D)
+                for method in methods:
+                    # each job gets a seed derived from the base seed and the job
+                    job_seed = np.random.SeedSequence([seed, N, L, D, METHODS.index(method)]).generate_state(1)[0]
+                    yield args.task, N, L, D, method, job_seed, manifest_dicts[method], raw_dict, token_dict
+
+def main():
+    # example
+    # python preprocess.py --task aor --N 10 --L 5 --D 10000
+    # python preprocess.py --task aes --N 10 20 --L 5 6 --D 10000 20000 --workers 6
+    # parameters
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--task', 
+        type=str, 
+        required=True, 
+        choices=TASKS, 
+        help='defines the task to pre-process')
+    parser.add_argument('--N', 
+        type=int, 
+        nargs='+', 
+        required=True, 
+        help='defines the numbers of unique integers')
+    parser.add_argument('--L', 
+        type=int, 
+        nargs='+', 
+        required=True, 
+        help='defines the numbers of integers in an equation')
+    parser.add_argument('--D', 
+        type=int, 
+        nargs='+', 
+        required=True, 
+        help='defines the numbers of unique equations')
+    parser.add_argument('--methods', 
+        type=str, 
+        nargs='+', 
+        default=METHODS, 
+        choices=METHODS, 
+        help='defines the methods to pre-process for')
+    parser.add_argument('--workers', 
+        type=int, 
+        default=len(METHODS), 
+        help='defines the number of processes')
+    parser.add_argument('--seed', 
+        type=int, 
+        default=None, 
+        help='defines the random seed for reproducible pre-processing')
+    parser.add_argument('--editops_cache_size', 
+        type=int, 
+        default=2**16, 
+        help='defines the max number of (x, y) pairs in the aec editops cache of each process')
+    parser.add_argument('--force', 
+        action='store_true', 
+        help='rebuilds every cell even if its manifest is up to date')
+    args = parser.parse_args()
+    seed = np.random.SeedSequence(args.seed).entropy
+    if args.task == 'aec':
+        # forked workers inherit the empty cache
+        TASK_UTILS[args.task].init_editops_cache(args.editops_cache_size)
+    with mp.Pool(args.workers) as pool:
+        for outdir in pool.imap_unordered(preprocess, gen_job_list(args, seed)):
+            print('Processed Data saved under {}'.format(outdir))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+__author__ = 'Shining'
+__email__ = 'mrshininnnnn@gmail.com'
+
+# dependency
+# public
+import os
+import importlib.util
+
+
+# the data generators own the exact evaluator
+# data/ is a folder of scripts rather than a package, so its utils are loaded by path
+DATA_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir, os.pardir, 'data')
+
+def load_data_utils():
+    spec = importlib.util.spec_from_file_location('data_utils', os.path.join(DATA_PATH, 'utils.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+data_utils = load_data_utils()
+
+# safe arithmetic evaluation
+# integers with + - * / ( ) only, evaluated as exact rationals
+eval_tokens = data_utils.eval_tokens
+eval_tokens_batch = data_utils.eval_tokens_batch
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+__author__ = 'Shining'
+__email__ = 'mrshininnnnn@gmail.com'
+
+# dependency
+# public
+import Levenshtein
+from functools import lru_cache
+
+
+# the editops cache shared by the online pipeline and the pre-processing of aec
+# token to code point table of the editops cache
+# derived from the vocab and extended by unseen tokens
+TOKEN2CHAR = dict()
+
+def encode_chars(seq: tuple) -> str:
+    return ''.join([TOKEN2CHAR[token] if token in TOKEN2CHAR 
+        else TOKEN2CHAR.setdefault(token, chr(len(TOKEN2CHAR))) for token in seq])
+
+def gen_editops(source: tuple, target: tuple) -> tuple:
+    return tuple(Levenshtein.editops(encode_chars(source), encode_chars(target)))
+
+cached_editops = lru_cache(maxsize=2**16)(gen_editops)
+
+def init_editops_cache(symbols: list = [], maxsize: int = 2**16) -> None:
+    # a fresh cache of maxsize pairs over the code points of the symbols
+    global cached_editops
+    TOKEN2CHAR.clear()
+    encode_chars(symbols)
+    cached_editops = lru_cache(maxsize=maxsize)(gen_editops)
+
+def editops_cache_counts() -> list:
+    # hits, misses and size of the cache in the current process
+    info = cached_editops.cache_info()
+    return [info.hits, info.misses, info.currsize]
+
+def sum_editops_cache_counts(rows: list) -> dict:
+    hits, misses, size = [sum(row[k] for row in rows) for k in range(3)]
+    # every miss adds a pair and the cache is never cleared
+    return {'hits': hits, 'misses': misses, 'evictions': misses - size, 
+        'size': size, 'hit_rate': hits / max(hits + misses, 1)}
+
+def editops_cache_info() -> dict:
+    return sum_editops_cache_counts([editops_cache_counts()])
+
+def levenshtein_editops_list(source, target):
+    # memoized on token tuples
+    return cached_editops(tuple(source), tuple(target))
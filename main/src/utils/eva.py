@@ -8,6 +8,9 @@ __email__ = 'mrshininnnnn@gmail.com'
 # public
 import numpy as np
 
+# private
+from .calc import eval_tokens_batch
+
 class Evaluate():
     """a class to process evaluation"""
     def __init__(self, config, targets, predictions, idx2vocab_dict, train=False): 
@@ -32,7 +35,7 @@ class Evaluate():
             # generate an evaluation message
             self.eva_msg += ' Equation Acc:{:.4f}'.format(self.eq_acc)
 
-    def check_equation(self, tgt, pred): 
+    def parse_equation(self, tgt, pred): 
         # remove end symbol
         if self.config.method == 'e2e':
             # remove end symbol
@@ -46,17 +49,20 @@ class Evaluate():
         tgt_nums = [t for t in tgt if t.isdigit()]
         # e.g., ['3', '3', '9', '3', '6']
         pred_nums = [p for p in pred if p.isdigit()]
-        # eval('123') return 123
-        # eval('1 2 3') raise error
-        try:
-            if tgt_nums == pred_nums and pred[-1].isdigit() and pred[-2] == '==':
-                    right = int(pred[-1])
-                    left = eval(' '.join(pred[:-2]))
-                    if left == right:
-                        return 1
-        except:
-            return 0
-        return 0
+        # the left side to evaluate and the right side to compare
+        if tgt_nums == pred_nums and len(pred) > 2 and pred[-1].isdigit() and pred[-2] == '==':
+            return pred[:-2], int(pred[-1])
+        return None
+
+    def check_equation(self, tgt, pred): 
+        return self.get_equation_hits([self.parse_equation(tgt, pred)])
+
+    def get_equation_hits(self, equations): 
+        # evaluate all left sides at once with the safe evaluator
+        # invalid left sides evaluate to None and never hold
+        equations = [e for e in equations if e is not None]
+        lefts = eval_tokens_batch([left for left, _ in equations])
+        return sum(1 for v, (_, right) in zip(lefts, equations) if v is not None and v == right)
 
     def check_token(self, tar, pred):
         min_len = min([len(tar), len(pred)])
@@ -69,11 +75,8 @@ class Evaluate():
         return 0
 
     def get_eq_acc(self):
-        a = 0
-        for i in range(self.size):
-            tar = self.tars[i]
-            pred = self.preds[i]
-            a += self.check_equation(tar, pred)
+        equations = [self.parse_equation(self.tars[i], self.preds[i]) for i in range(self.size)]
+        a = self.get_equation_hits(equations)
         return np.float32(a/self.size)
 
     def get_token_acc(self):
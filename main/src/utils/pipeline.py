@@ -10,11 +10,15 @@ import torch
 torch.manual_seed(0)
 from torch.utils import data as torch_data
 
+import os
 import copy
+import time
 import random
+import traceback
 import numpy as np
 np.random.seed(0)
-import Levenshtein 
+import multiprocessing as mp
+from itertools import chain
 
 # private
 from ..models import (
@@ -22,16 +26,23 @@ from ..models import (
     gru_rnn, lstm_rnn, 
     bi_gru_rnn, bi_lstm_rnn, 
     bi_gru_rnn_att, bi_lstm_rnn_att)
+from .calc import data_utils
+from . import editops as editops_utils
+from .editops import levenshtein_editops_list
+from .store import gen_token_array
+from .vocab import Vocab, split_rows
 
 
+# datasets are backed by token arrays, either memory-mapped or packed from lists
+# so that data loader workers share one copy of the data
 class OfflineDataset(torch_data.Dataset):
     """docstring for OfflineDataset"""
     def __init__(self, data_dict):
         super(OfflineDataset, self).__init__()
-        self.xs = data_dict['xs']
-        self.ys = data_dict['ys']
+        self.xs = gen_token_array(data_dict['xs'])
+        self.ys = gen_token_array(data_dict['ys'])
         if 'ys_' in data_dict:
-            self.ys_ = data_dict['ys_']
+            self.ys_ = gen_token_array(data_dict['ys_'])
         else:
             self.ys_ = None
         self.data_size = len(self.ys)
@@ -39,6 +50,9 @@ class OfflineDataset(torch_data.Dataset):
     def __len__(self): 
         return self.data_size
 
+    def lengths(self):
+        return self.xs.lens()
+
     def __getitem__(self, idx): 
         if self.ys_ is None: 
             return self.xs[idx], self.ys[idx] 
@@ -48,18 +62,94 @@ class OfflineDataset(torch_data.Dataset):
 
 class OnlineDataset(torch_data.Dataset):
     """docstring for OnlineDataset"""
-    def __init__(self, data_dict):
+    def __init__(self, data_dict, aes=None, aec=None):
         super(OnlineDataset, self).__init__() 
-        self.ys = data_dict['ys']
+        self.ys = gen_token_array(data_dict['ys'])
         self.data_size = len(self.ys)
+        # to bound the lengths of aes and aec inputs
+        self.aes = aes
+        self.aec = aec
 
     def __len__(self): 
         return self.data_size
 
+    def lengths(self):
+        # inputs are sampled from targets, so their lengths are bounded by the targets
+        if self.aes is not None:
+            return self.aes.max_input_lens(self.ys)
+        elif self.aec is not None:
+            return self.aec.max_input_lens(self.ys)
+        # aor inputs miss some operators of their targets
+        return self.ys.lens()
+
     def __getitem__(self, idx): 
         return self.ys[idx]
 
 
+# batches of samples with similar lengths
+# so that little of a padded batch is padding
+class BucketBatchSampler(object):
+    """docstring for BucketBatchSampler"""
+    def __init__(self, lengths, batch_size, max_tokens=None, shuffle=True, drop_last=False, seed=0):
+        super(BucketBatchSampler, self).__init__()
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        # only batches capped by batch size are dropped
+        self.drop_last = drop_last and max_tokens is None
+        self.seed = seed
+        self.epoch = 0
+        self.data_size = len(self.lengths)
+        if self.drop_last:
+            self.data_size -= self.data_size % batch_size
+        self.batch_sizes = self.gen_batch_sizes(np.sort(self.lengths)[:self.data_size])
+
+    def gen_batch_sizes(self, lengths):
+        # batch sizes over the sorted lengths
+        if self.max_tokens is None:
+            batch_sizes = [self.batch_size] * (len(lengths) // self.batch_size)
+            if len(lengths) % self.batch_size:
+                batch_sizes.append(len(lengths) % self.batch_size)
+            return batch_sizes
+        # a batch takes samples as long as its padded inputs fit into max tokens
+        batch_sizes, batch_size = [], 0
+        for l in lengths.tolist():
+            if batch_size and (batch_size + 1) * l > self.max_tokens:
+                batch_sizes.append(batch_size)
+                batch_size = 0
+            batch_size += 1
+        if batch_size:
+            batch_sizes.append(batch_size)
+        return batch_sizes
+
+    def __iter__(self):
+        # a random stream per epoch
+        rng = np.random.default_rng([self.seed, self.epoch])
+        self.epoch += 1
+        if self.shuffle:
+            # random ties shuffle samples within a bucket
+            idxes = np.lexsort((rng.random(len(self.lengths)), self.lengths))
+        else:
+            idxes = np.argsort(self.lengths, kind='stable')
+        if self.data_size < len(idxes):
+            # drop random samples instead of the longest ones
+            if self.shuffle:
+                idxes = idxes[np.sort(rng.permutation(len(idxes))[:self.data_size])]
+            else:
+                idxes = idxes[:self.data_size]
+        idxes = idxes.tolist()
+        ends = np.cumsum(self.batch_sizes).tolist()
+        batches = [idxes[end-size:end] for end, size in zip(ends, self.batch_sizes)]
+        if self.shuffle:
+            # shuffle buckets
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return iter(batches)
+
+    def __len__(self): 
+        return len(self.batch_sizes)
+
+
 def pick_model(config, method):
     if config.model_name == 'transformer':
         if method == 'e2e':
@@ -148,21 +238,13 @@ def show_config(config, model):
 
     return general_info
 
-def translate(seq: list, trans_dict: dict) -> list: 
-    return [trans_dict[token] for token in seq]
-
-def rm_idx(seq, idx):
-    return [i for i in seq if i != idx]
-
 def post_process(srcs, tgts, preds, config): 
     # remove pad idx
-    srcs = [rm_idx(src, config.pad_idx) for src in srcs] 
-    tgts = [rm_idx(tgt, config.pad_idx) for tgt in tgts] 
-    preds = [rm_idx(pred, config.pad_idx) for pred in preds] 
-    if config.method in ['e2e', 'tag']:
-        # remove end idx
-        end_idxes = [p.index(config.end_idx)+1 if config.end_idx in p else len(p) for p in preds]
-        preds = [p[:idx] for idx, p in zip(end_idxes, preds)]
+    srcs = Vocab.strip_pad(srcs, config.pad_idx)
+    tgts = Vocab.strip_pad(tgts, config.pad_idx)
+    # remove end idx
+    end_idx = config.end_idx if config.method in ['e2e', 'tag'] else None
+    preds = Vocab.strip_pad(preds, config.pad_idx, end_idx)
     return srcs, tgts, preds
 
 def save_check_point(step, epoch, model_state_dict, opt_state_dict, path):
@@ -175,11 +257,11 @@ def save_check_point(step, epoch, model_state_dict, opt_state_dict, path):
     torch.save(checkpoint_to_save, path)
     print('Model saved as {}.'.format(path))
 
-def rand_sample(srcs, tars, preds, src_dict, tar_dict, pred_dict): 
+def rand_sample(srcs, tars, preds, src_vocab, tar_vocab, pred_vocab): 
     src, tar, pred = random.choice([(src, tar, pred) for src, tar, pred in zip(srcs, tars, preds)])
-    src = translate(src, src_dict)
-    tar = translate(tar, tar_dict)
-    pred = translate(pred, pred_dict)
+    src = src_vocab.decode([src])[0]
+    tar = tar_vocab.decode([tar])[0]
+    pred = pred_vocab.decode([pred])[0]
     return ' '.join(src), ' '.join(tar), ' '.join(pred)
 
 # for swap sort
@@ -211,33 +293,34 @@ class ArithmeticEquationSimplification():
         self.pos_digits = np.arange(2, config.N+2).tolist()
         self.neg_digits = np.arange(-config.N, -1).tolist()
         self.digits = self.pos_digits + self.neg_digits
+        self.cache_path = config.CACHE_PATH
         self.base_dict = self.gen_base_dict()
 
     def gen_base_dict(self):
-        base_dict = {str(i):[] for i in self.pos_digits}
-        for a in self.digits:
-            for o in self.operators:
-                for b in self.pos_digits:
-                    try:
-                        e = [str(a), o, str(b)]
-                        v = str(eval(''.join(e)))
-                        e[0] = e[0].replace('-', '- ')
-                        e = ' '.join(list(e))
-                        if v in base_dict: 
-                            base_dict[v].append('( {} )'.format(e))
-                    except:
-                        pass
-        return base_dict
-
-    def replace_numbers(self, ys):
+        # sub-expressions of each value
+        # loaded from the cache keyed by N and operators
+        # shared with the data generators, which build the same file
+        return data_utils.load_base_dict(self.digits, self.pos_digits, self.operators, self.cache_path)
+
+    def max_input_lens(self, ys):
+        # every number of a target may be replaced by its longest sub-expression
+        growth = {v: max(len(e.split()) for e in es) - 1 for v, es in self.base_dict.items()}
+        tokens, offsets = ys.open()
+        extra = np.array([growth.get(symbol, 0) for symbol in ys.symbols], dtype=np.int64)[tokens]
+        extra = np.concatenate([[0], np.cumsum(extra)])
+        return ys.lens() + extra[offsets[1:]] - extra[offsets[:-1]]
+
+    def replace_numbers(self, ys, rng):
         ys = copy.deepcopy(ys)
         xs = []
         for y in ys: 
             num_idx = [i for i, token in enumerate(y) if token.isdigit()]
-            num_to_replace = np.random.choice(range(len(num_idx)+1))
-            idx_to_replace = np.random.choice(num_idx, num_to_replace, False)
-            for i in idx_to_replace:
-                y[i] = np.random.choice(self.base_dict[y[i]])
+            num_to_replace = rng.integers(len(num_idx)+1)
+            idx_to_replace = rng.choice(len(num_idx), num_to_replace, replace=False)
+            for i in idx_to_replace.tolist():
+                i = num_idx[i]
+                sub_expressions = self.base_dict[y[i]]
+                y[i] = sub_expressions[rng.integers(len(sub_expressions))]
             xs.append(' '.join(y).split())
         return xs
 
@@ -253,104 +336,223 @@ class ArithmeticEquationCorrection():
         self.neg_digits = np.arange(-config.N, -1).tolist()
         self.digits = self.pos_digits + self.neg_digits
         
-        def delete(tk_y, idx): 
+        self.tokens = self.operators + self.pos_digits
+        
+        def delete(tk_y, idx, rng): 
             tk_y[idx] = ''
             return tk_y
-        def insert(tk_y, idx): 
-            tk_y[idx] = str(np.random.choice(self.operators+self.pos_digits)) + ' ' + tk_y[idx]
+        def insert(tk_y, idx, rng): 
+            tk_y[idx] = str(self.tokens[rng.integers(len(self.tokens))]) + ' ' + tk_y[idx]
             return tk_y 
-        def sub(tk_y, idx):
-            tk_y[idx] = str(np.random.choice(self.operators+self.pos_digits))
+        def sub(tk_y, idx, rng):
+            tk_y[idx] = str(self.tokens[rng.integers(len(self.tokens))])
             return tk_y
         
         self.trans_funs = [delete, insert, sub]
     
-    def transform(self, y, idxes): 
+    def transform(self, y, idxes, rng): 
         tk_y = y.copy()
         for idx in idxes: 
-            f = np.random.choice(self.trans_funs)
-            tk_y = f(tk_y, idx)
+            f = self.trans_funs[rng.integers(len(self.trans_funs))]
+            tk_y = f(tk_y, idx, rng)
         return tk_y
         
-    def random_transform(self, ys): 
+    def max_input_lens(self, ys):
+        # every error inserts at most one token
+        # and no step towards the target is longer than that
+        return ys.lens() + self.num_errors
+
+    def random_transform(self, ys, rng): 
         xs = []
         for y in ys:
             y_len = len(y) - 1
-            num_idxes = np.random.choice(range(self.num_errors+1))
-            idxes = sorted(np.random.choice(range(y_len), num_idxes, False))
-            x = self.transform(y, idxes)
+            num_idxes = rng.integers(self.num_errors+1)
+            idxes = sorted(rng.choice(y_len, num_idxes, replace=False).tolist())
+            x = self.transform(y, idxes, rng)
             xs.append(' '.join([i for i in x if len(i)>0]).split())
         return xs
 
 
-def levenshtein_editops_list(source, target):
-    unique_elements = sorted(set(source + target)) 
-    char_list = [chr(i) for i in range(len(unique_elements))]
-    if len(unique_elements) > len(char_list):
-        raise Exception("too many elements")
-    else:
-        unique_element_map = {ele:char_list[i]  for i, ele in enumerate(unique_elements)}
-    source_str = ''.join([unique_element_map[ele] for ele in source])
-    target_str = ''.join([unique_element_map[ele] for ele in target])
-    transform_list = Levenshtein.editops(source_str, target_str)
-    return transform_list
-
-def aes_sampler(ys: list, aes) -> list: 
-    xs = aes.replace_numbers(ys.copy())
+# hits, misses and size of the editops cache of each process
+# row 0 is the main process and row i+1 the i-th data loader worker
+EDITOPS_STATS = None
+# set in batch producer processes
+PRODUCER_ID = 0
+# the random stream of online generation in the current process
+RNG = None
+
+def init_editops_cache(symbols: list, maxsize: int = 2**16, num_workers: int = 0) -> None:
+    # a fresh cache of maxsize pairs over the code points of the vocab
+    global EDITOPS_STATS
+    editops_utils.init_editops_cache(symbols, maxsize)
+    # forked workers inherit the shared counters
+    EDITOPS_STATS = mp.RawArray('q', 3*(num_workers+1))
+
+def get_worker_id() -> int:
+    # 0 for the main process and from 1 for data loader workers or batch producers
+    worker_info = torch_data.get_worker_info()
+    return PRODUCER_ID if worker_info is None else worker_info.id + 1
+
+def seed_worker_rng(seed: int, epoch: int) -> None:
+    # an independent stream for each base seed, epoch, and process
+    global RNG
+    RNG = np.random.default_rng([seed, epoch, get_worker_id()])
+
+def get_worker_rng() -> np.random.Generator:
+    if RNG is None:
+        seed_worker_rng(0, 0)
+    return RNG
+
+def record_pairs(pairs: set, xs, x_lens, ys, pad_idx: int) -> None:
+    # collect the unique (x, y_) pairs of padded batches
+    # so that duplicates drawn by different workers can be counted
+    xs, ys = xs.numpy(), ys.numpy()
+    y_lens = (ys != pad_idx).sum(axis=1).tolist()
+    for x, x_len, y, y_len in zip(xs, x_lens.long().tolist(), ys, y_lens):
+        pairs.add((x[:x_len].tobytes(), y[:y_len].tobytes()))
+
+def record_editops_stats() -> None:
+    # publish the counters of the current process
+    if EDITOPS_STATS is not None:
+        i = get_worker_id()
+        EDITOPS_STATS[3*i:3*i+3] = editops_utils.editops_cache_counts()
+
+def editops_cache_info() -> dict:
+    # counters summed over the main process and the workers
+    record_editops_stats()
+    if EDITOPS_STATS is None:
+        return editops_utils.editops_cache_info()
+    rows = [EDITOPS_STATS[i:i+3] for i in range(0, len(EDITOPS_STATS), 3)]
+    return editops_utils.sum_editops_cache_counts(rows)
+
+def aes_sampler(ys: list, aes, rng) -> list: 
+    xs = aes.replace_numbers(ys.copy(), rng)
     return [(x, y) for x, y in zip(xs, ys)]
 
-def aec_sampler(ys: list, aec) -> list:
-    xs = aec.random_transform(ys.copy())
+def aec_sampler(ys: list, aec, rng) -> list:
+    xs = aec.random_transform(ys.copy(), rng)
     return [(x, y) for x, y in zip(xs, ys)]
 
-def inverse_sampler(data, data_src, aes=None, aec=None): 
+def inverse_sampler(data, data_src, rng, aes=None, aec=None): 
     if data_src == 'aes': 
-        return aes_sampler(data, aes) 
+        return aes_sampler(data, aes, rng) 
     elif data_src == 'aor': 
         return data
     elif data_src == 'aec': 
-        return aec_sampler(data, aec)
-
-def e2e_online_generator(data_src: str, data) -> list:
-    # online training data generation for end2end
-    # for Arithmetic Equation Simplification (AES) 
-    if data_src == 'aes': 
-        x, y = data
-        xs = [x.copy()]
-        num_left = len([i for i in x if i == '('])
-        for i in range(num_left):
-            left_idx = x.index('(') 
-            right_idx = x.index(')') 
-            v = y[left_idx] 
-            x = x[:left_idx] + [v] + x[right_idx+1:]
-            xs.append(x)
-        index = np.random.choice(range(len(xs)))
-        x = xs[index]
-        return x, y
-    # for Arithmetic Operators Restoration (AOR)
-    elif data_src == 'aor':
-        # make a copy
-        y = data.copy()
-        x = y.copy()
-        # get operator indexes
-        operator_idxes = [i for i, token in enumerate(y) if not token.isdigit()][::-1]
-        # decide how many operators to remove
-        num_idxes = np.random.choice(range(len(operator_idxes)+1))
-        # decide operators to remove
-        idxes_to_remove = operator_idxes[:num_idxes]
-        x = [x[i] for i in range(len(x)) if i not in idxes_to_remove]
-        return x, y
-    # for Arithmetic Equation Correction (AEC)
-    elif data_src == 'aec': 
-        # make a copy
-        x, y = data
-        xs = [x.copy()] 
-        editops = levenshtein_editops_list(x, y)
-        if len(editops) == 0: 
-            return x, y
+        return aec_sampler(data, aec, rng)
+
+def gen_aes_spans(x: list, y: list) -> list:
+    # the (left, right, value) of every reduction step of an AES sample in one scan
+    # positions are in the state that a reduction applies to
+    spans, shift, left = [], 0, None
+    for i, token in enumerate(x):
+        if token == '(':
+            left = i - shift
+        elif token == ')':
+            right = i - shift
+            spans.append((left, right, y[left]))
+            shift += right - left
+    return spans
+
+def apply_aes_spans(x: list, spans: list) -> list:
+    # apply reductions in order in one pass over x
+    state, start, shift = [], 0, 0
+    for left, right, v in spans:
+        state += x[start:left+shift]
+        state.append(v)
+        start = right + shift + 1
+        shift += right - left
+    return state + x[start:]
+
+def gen_aes_tags(x: list, spans: list) -> list:
+    # keep every token and substitute the remaining reductions
+    y_ = ['<keep>'] * len(x)
+    shift = 0
+    for left, right, v in spans:
+        y_[left+shift] = '<sub_{}>'.format(v)
+        y_[left+shift+1:right+shift+1] = ['<delete>'] * (right - left)
+        shift += right - left
+    return y_
+
+
+# the edit trajectories of a batch of samples, each kept as the list of its steps
+# aes steps are reductions by parenthesis span and aec steps are edit operations
+# aor steps remove operators from the right, so they are ranks in a padded token matrix
+# so that a sampled step is applied directly instead of walking every state
+# the index is built again for every batch, since aes and aec inputs are corrupted anew in each batch
+class TrajectoryIndex(object):
+    """docstring for TrajectoryIndex"""
+    def __init__(self, data_src, data):
+        super(TrajectoryIndex, self).__init__()
+        self.data_src = data_src
+        self.data = list(data)
+        if data_src == 'aor':
+            self.index_operators()
         else:
-            c = 0 
-            for tag, i, j in editops: 
+            if data_src == 'aes':
+                self.steps = [gen_aes_spans(x, y) for x, y in self.data]
+            elif data_src == 'aec':
+                self.steps = [levenshtein_editops_list(x, y) for x, y in self.data]
+            # every trajectory ends with <done>
+            self.num_steps = np.fromiter(map(len, self.steps), dtype=np.int64, count=len(self.steps)) + 1
+
+    def index_operators(self):
+        # the targets are padded into a token matrix
+        ys = self.data
+        lens = np.fromiter(map(len, ys), dtype=np.int64, count=len(ys))
+        self.valid = np.arange(int(lens.max())) < lens[:, None]
+        flat = list(chain.from_iterable(ys))
+        self.tokens = np.empty(self.valid.shape, dtype=object)
+        self.tokens[self.valid] = flat
+        self.is_operator = np.zeros(self.valid.shape, dtype=bool)
+        self.is_operator[self.valid] = ~np.fromiter(map(str.isdigit, flat), dtype=bool, count=len(flat))
+        # the rank of each operator counted from the right
+        self.ranks = np.cumsum(self.is_operator[:, ::-1], axis=1)[:, ::-1]
+        self.num_steps = self.is_operator.sum(axis=1) + 1
+
+    def get_operators(self, method, steps):
+        # the whole batch is edited with masks, the k-th step misses the last k operators
+        removed = self.is_operator & (self.ranks <= steps[:, None])
+        kept = self.valid & ~removed
+        xs = split_rows(self.tokens[kept].tolist(), kept.sum(axis=1).tolist())
+        if method == 'e2e':
+            return xs, self.data
+        elif method == 'rec':
+            # restore the leftmost missing operator
+            rows, cols = np.nonzero(self.is_operator & (self.ranks == steps[:, None]))
+            ys_ = [['<done>', '<done>'] for _ in self.data]
+            for row, col, token in zip(rows.tolist(), cols.tolist(), self.tokens[rows, cols].tolist()):
+                ys_[row] = ['<pos_{}>'.format(col), token]
+            return xs, ys_
+        elif method == 'tag':
+            # keep present tokens and insert missing operators up to the last present token
+            tags = np.full(self.valid.shape, '<keep>', dtype=object)
+            tags[removed] = ['<insert_{}>'.format(token) for token in self.tokens[removed].tolist()]
+            tag_lens = self.valid.shape[1] - np.argmax(kept[:, ::-1], axis=1)
+            return xs, [tag[:l] for tag, l in zip(tags.tolist(), tag_lens.tolist())]
+
+    def __len__(self):
+        return len(self.data)
+
+    def sample_steps(self, rng):
+        # pick an intermediate step of every sample
+        return rng.integers(self.num_steps)
+
+    def get_state(self, idx, step):
+        # the input after the first step edits and the recurrent action on it
+        x, y = self.data[idx]
+        steps = self.steps[idx]
+        if self.data_src == 'aes':
+            if step < len(steps):
+                left, right, v = steps[step]
+                action = ['<pos_{}>'.format(left), '<pos_{}>'.format(right), v]
+            else:
+                action = ['<done>']*3
+            return apply_aes_spans(x, steps[:step]), action
+        elif self.data_src == 'aec':
+            x = x.copy()
+            c = 0
+            for tag, i, j in steps[:step]:
                 i += c
                 if tag == 'replace':
                     x[i] = y[j]
@@ -358,97 +560,67 @@ def e2e_online_generator(data_src: str, data) -> list:
                     del x[i]
                     c -= 1
                 elif tag == 'insert':
-                    x.insert(i, y[j]) 
+                    x.insert(i, y[j])
                     c += 1
-                xs.append(x.copy())
-            index = np.random.choice(range(len(xs)))
-            x = xs[index]
-        return x, y
+            if step == len(steps):
+                return x, ['<done>']*3
+            tag, i, j = steps[step]
+            i += c
+            if tag == 'replace':
+                action = ['<sub>', '<pos_{}>'.format(i), y[j]]
+            elif tag == 'delete':
+                # action = ['<delete>', '<pos_{}>'.format(i), '<done>']
+                action = ['<delete>', '<pos_{}>'.format(i), '<pos_{}>'.format(i)]
+            elif tag == 'insert':
+                action = ['<insert>', '<pos_{}>'.format(i), y[j]]
+            return x, action
+
+    def get(self, method, steps):
+        # inputs and labels of the given steps
+        if self.data_src == 'aor':
+            return self.get_operators(method, steps)
+        xs, labels = [], []
+        for idx, step in enumerate(steps.tolist()):
+            x, action = self.get_state(idx, step)
+            y = self.data[idx][1]
+            xs.append(x)
+            if method == 'e2e':
+                labels.append(y)
+            elif method == 'rec':
+                labels.append(action)
+            elif method == 'tag':
+                if self.data_src == 'aes':
+                    labels.append(gen_aes_tags(x, self.steps[idx][step:]))
+                else:
+                    labels.append(tag_offline_generator(self.data_src, (x, y))[1])
+        return xs, labels
+
+    def sample(self, method, rng):
+        return self.get(method, self.sample_steps(rng))
+
 
-def rec_online_generator(data_src: str, data: list) -> list:
+def e2e_online_generator(data_src: str, data, rng) -> list:
+    # online training data generation for end2end
+    # pick an intermediate step
+    xs, ys = TrajectoryIndex(data_src, [data]).sample('e2e', rng)
+    return xs[0], ys[0]
+
+def rec_online_generator(data_src: str, data: list, rng) -> list:
     # online training data generation for recurrent inference
-    # for Arithmetic Equation Simplification (AES) 
-    if data_src == 'aes': 
-        x, y = data
-        xs = [x.copy()]
-        ys_ = []
-        num_left = len([i for i in x if i == '('])
-        for i in range(num_left):
-            left_idx = x.index('(') 
-            right_idx = x.index(')') 
-            v = y[left_idx] 
-            ys_.append(['<pos_{}>'.format(left_idx), '<pos_{}>'.format(right_idx), v])
-            x = x[:left_idx] + [v] + x[right_idx+1:]
-            xs.append(x)
-        ys_.append(['<done>']*3)
-        index = np.random.choice(range(len(xs)))
-        x = xs[index]
-        y_ = ys_[index]
-        return x, y_
-    # for Arithmetic Operators Restoration (AOR)
-    elif data_src == 'aor':
-        # make a copy
-        y = data.copy() # list
-        x = y.copy()
-        # get operator indexes
-        operator_idxes = [i for i, token in enumerate(y) if not token.isdigit()][::-1]
-        # decide how many operators to remove
-        num_idxes = np.random.choice(range(len(operator_idxes)+1))
-        if num_idxes == 0:
-            return x, ['<done>', '<done>']
-        else:
-            # decide operators to remove
-            idxes_to_remove = operator_idxes[:num_idxes]
-            # generat label
-            y_ = ['<pos_{}>'.format(idxes_to_remove[-1]), x[idxes_to_remove[-1]]]
-            # generate sample
-            x = [x[i] for i in range(len(x)) if i not in idxes_to_remove]
-            return x, y_
-    # for Arithmetic Equation Correction (AEC)
-    elif data_src == 'aec': 
-        x, y = data
-        xs = [x.copy()]
-        ys_ = []
-        editops = levenshtein_editops_list(x, y)
-        if len(editops) == 0: 
-            y_ = ['<done>']*3 
-            return x, y_ 
-        else:
-            c = 0 
-            for tag, i, j in editops: 
-                i += c
-                if tag == 'replace':
-                    y_ = ['<sub>', '<pos_{}>'.format(i), y[j]]
-                    x[i] = y[j]
-                elif tag == 'delete': 
-                    # y_ = ['<delete>', '<pos_{}>'.format(i), '<done>'] 
-                    y_ = ['<delete>', '<pos_{}>'.format(i), '<pos_{}>'.format(i)]
-                    del x[i]
-                    c -= 1
-                elif tag == 'insert': 
-                    y_ = ['<insert>', '<pos_{}>'.format(i), y[j]]
-                    x.insert(i, y[j]) 
-                    c += 1
-                xs.append(x.copy()) 
-                ys_.append(y_)
-            ys_.append(['<done>']*3)
-            index = np.random.choice(range(len(xs)))
-            x = xs[index]
-            y_ = ys_[index]
-        return x, y_
+    # pick an intermediate step and its action
+    xs, ys_ = TrajectoryIndex(data_src, [data]).sample('rec', rng)
+    return xs[0], ys_[0]
 
 def rec_offline_generator(data_src: str, data) -> list: 
     # for Arithmetic Equation Simplification (AES) 
     if data_src == 'aes':
         x, y = data
-        num_left = len([i for i in x if i == '('])
-        if num_left == 0:
+        spans = gen_aes_spans(x, y)
+        if len(spans) == 0:
             y_ = ['<done>']*3
         else:
-            left_idx = x.index('(') 
-            right_idx = x.index(')') 
-            v = y[left_idx] 
-            y_ = ['<pos_{}>'.format(left_idx), '<pos_{}>'.format(right_idx), v]
+            left, right, v = spans[0]
+            y_ = ['<pos_{}>'.format(left), '<pos_{}>'.format(right), v]
         return x, y_
     # for Arithmetic Operators Restoration (AOR)
     elif data_src == 'aor': 
@@ -470,139 +642,16 @@ def rec_offline_generator(data_src: str, data) -> list:
                 y_ = ['<insert>', '<pos_{}>'.format(i), y[j]] 
         return x, y_
 
-def tag_online_generator(data_src: str, data) -> list:
-    # for Arithmetic Equation Simplification (AES) 
-    if data_src == 'aes': 
-        # pick an intermediate step
-        x, y = data
-        xs = [x.copy()]
-        num_left = len([i for i in x if i == '('])
-        for i in range(num_left):
-            left_idx = x.index('(') 
-            right_idx = x.index(')') 
-            v = y[left_idx] 
-            x = x[:left_idx] + [v] + x[right_idx+1:]
-            xs.append(x)
-        index = np.random.choice(range(len(xs)))
-        x = xs[index]
-        # convert to a tagging sequence
-        y_ = []
-        x_ = x.copy()
-        x_token = x_.pop(0)
-        for i in range(len(y)):
-            y_token = y[i]
-            if x_token == y_token:
-                y_.append('<keep>')
-                if len(x_) == 0:
-                    break
-                x_token = x_.pop(0)
-            else:
-                y_.append('<sub_{}>'.format(y_token))
-                x_token = x_.pop(0)
-                while True:
-                    y_.append('<delete>')
-                    if x_token == ')':
-                        if len(x_) != 0:
-                            x_token = x_.pop(0)
-                        break
-                    x_token = x_.pop(0)
-        return x, y_
-    # for Arithmetic Operators Restoration (AOR)
-    elif data_src == 'aor':
-        # make a copy
-        y = data
-        x = data.copy()
-        # get operator indexes
-        operator_idxes = [i for i, token in enumerate(y) if not token.isdigit()][::-1]
-        # decide how many operators to remove
-        num_idxes = np.random.choice(range(len(operator_idxes)+1))
-        if num_idxes == 0:
-            return x, ['<keep>']*len(y)
-        else:
-            # decide operators to remove
-            idxes_to_remove = operator_idxes[:num_idxes]
-            x = [x[i] for i in range(len(x)) if i not in idxes_to_remove]
-            # convert to tagging sequences
-            x_ = x.copy()
-            y_ = []
-            x_token = x_.pop(0)
-            for i in range(len(y)):
-                y_token = y[i]
-                if x_token == y_token: 
-                    y_.append('<keep>')
-                    if len(x_) == 0:
-                        break
-                    x_token = x_.pop(0)
-                else:
-                    y_.append('<insert_{}>'.format(y_token))
-            return x, y_
-    # for Arithmetic Equation Correction (AEC)
-    elif data_src == 'aec': 
-        # pick an intermediate step
-        x, y = data
-        xs = [x.copy()] 
-        editops = levenshtein_editops_list(x, y)
-        if len(editops) == 0: 
-            return x, ['<keep>'] * len(x) 
-        else:
-            c = 0 
-            for tag, i, j in editops: 
-                i += c
-                if tag == 'replace':
-                    x[i] = y[j]
-                elif tag == 'delete':
-                    del x[i]
-                    c -= 1
-                elif tag == 'insert':
-                    x.insert(i, y[j]) 
-                    c += 1
-                xs.append(x.copy())
-            index = np.random.choice(range(len(xs)))
-            x = xs[index]
-            # convert to a tagging sequence
-            editops = levenshtein_editops_list(x, y)
-            y_ = ['<keep>'] * len(x)
-            c = 0
-            for tag, i, j in editops:
-                i += c
-                if tag == 'replace': 
-                    if y_[i] != '<keep>':
-                        y_.insert(i+1, '<sub_{}>'.format(y[j]))
-                        c += 1
-                    else:
-                        y_[i] = '<sub_{}>'.format(y[j])
-                elif tag == 'delete':
-                    y_[i] = '<delete>'
-                elif tag == 'insert': 
-                    y_.insert(i, '<insert_{}>'.format(y[j]))
-                    c += 1
-            return x, y_
+def tag_online_generator(data_src: str, data, rng) -> list:
+    # pick an intermediate step
+    xs, ys_ = TrajectoryIndex(data_src, [data]).sample('tag', rng)
+    return xs[0], ys_[0]
 
 def tag_offline_generator(data_src: str, data) -> list:
     # for Arithmetic Equation Simplification (AES) 
     if data_src == 'aes': 
         x, y = data
-        y_ = []
-        x_ = x.copy()
-        x_token = x_.pop(0)
-        for i in range(len(y)):
-            y_token = y[i]
-            if x_token == y_token:
-                y_.append('<keep>')
-                if len(x_) == 0:
-                    break
-                x_token = x_.pop(0)
-            else:
-                y_.append('<sub_{}>'.format(y_token))
-                x_token = x_.pop(0)
-                while True:
-                    y_.append('<delete>')
-                    if x_token == ')':
-                        if len(x_) != 0:
-                            x_token = x_.pop(0)
-                        break
-                    x_token = x_.pop(0)
-        return x, y_
+        return x, gen_aes_tags(x, gen_aes_spans(x, y))
     # for Arithmetic Operators Insertion (AOI)
     elif data_src == 'aor': 
         return data
@@ -626,54 +675,223 @@ def tag_offline_generator(data_src: str, data) -> list:
                 c += 1
         return x, y_
 
-def data_generator(data, config):
+def data_generator(data, config, rng):
+    # online steps of the whole batch are sampled from its trajectory index
+    if config.data_mode == 'online':
+        xs, ys = TrajectoryIndex(config.data_src, data).sample(config.method, rng)
     # for end2end
-    if config.method == 'e2e':
-        if config.data_mode == 'online': 
-            xs, ys = zip(*[e2e_online_generator(config.data_src, d) for  d in data])
-        elif config.data_mode == 'offline': 
-            xs, ys = zip(*data)
+    elif config.method == 'e2e':
+        xs, ys = zip(*data)
     # for recurrent inference
     elif config.method == 'rec': 
-        if config.data_mode == 'online':
-            xs, ys = zip(*[rec_online_generator(config.data_src, d) for d in data])
-        elif config.data_mode == 'offline':
-            xs, ys = zip(*[rec_offline_generator(config.data_src, d) for d in data])
+        xs, ys = zip(*[rec_offline_generator(config.data_src, d) for d in data])
     # for tagging
     elif config.method == 'tag':
-        if config.data_mode == 'online':
-            xs, ys = zip(*[tag_online_generator(config.data_src, d) for d in data])
-        elif config.data_mode == 'offline':
-            xs, ys = zip(*[tag_offline_generator(config.data_src, d) for d in data])
+        xs, ys = zip(*[tag_offline_generator(config.data_src, d) for d in data])
+    if config.data_src == 'aec':
+        record_editops_stats()
 
     return xs, ys
 
-def preprocess(xs, ys, src_vocab2idx_dict, tgt_vocab2idx_dict, config, train=True): 
+def preprocess(xs, ys, src_vocab, tgt_vocab, config, train=True): 
     # vocab to index
-    xs = [translate(x, src_vocab2idx_dict) for x in xs]
-    ys = [translate(y, tgt_vocab2idx_dict) for y in ys]
-    if config.method in ['e2e', 'tag'] and train:
-        # add end symbol and save as tensor
-        xs = [torch.Tensor(x) for x in xs]
-        ys = [torch.Tensor(y + [config.end_idx]) for y in ys] 
-    else:
-        # convert to tensor
-        xs = [torch.Tensor(x) for x in xs]
-        ys = [torch.Tensor(y) for y in ys] 
+    xs = src_vocab.encode(xs)
+    # add end symbol
+    end_idx = config.end_idx if config.method in ['e2e', 'tag'] and train else None
+    ys = tgt_vocab.encode(ys, end_idx)
 
     return xs, ys
 
-def padding(seqs, max_len=None):
+
+# a growing int64 buffer that padded batches are written into
+# views of it are handed out, so a batch is only valid until the next one
+class BatchBuffer(object):
+    """docstring for BatchBuffer"""
+    def __init__(self, pin_memory=False):
+        super(BatchBuffer, self).__init__()
+        self.pin_memory = pin_memory
+        self.storage = torch.zeros(0).long()
+
+    def get(self, batch_size, max_len):
+        size = batch_size * max_len
+        if size > len(self.storage):
+            self.storage = torch.zeros(size).long()
+            if self.pin_memory:
+                self.storage = self.storage.pin_memory()
+        padded_seqs = self.storage[:size].view(batch_size, max_len)
+        padded_seqs.zero_()
+        return padded_seqs
+
+def gen_batch_args(dataset, config, train=True):
+    # batching arguments of a data loader
+    if config.bucketing if train else config.eval_bucketing:
+        return {'batch_sampler': BucketBatchSampler(dataset.lengths(), config.batch_size, 
+            config.max_tokens, config.shuffle and train, config.drop_last and train, config.seed)}
+    return {'batch_size': config.batch_size, 
+        'shuffle': config.shuffle and train, 
+        'drop_last': config.drop_last and train}
+
+def gen_batch_buffers(config):
+    # buffers are reused only when batches are built in the main process
+    # worker batches are moved to shared memory and must own their storage
+    if config.num_workers == 0:
+        pin_memory = config.pin_memory and config.use_gpu
+        return BatchBuffer(pin_memory), BatchBuffer(pin_memory)
+    return None, None
+
+def padding(seqs, max_len=None, buffer=None):
     # zero padding
-    seq_lens = [len(seq) for seq in seqs]
+    # all sequences are written into the matrix at once
+    seq_lens = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
     if max_len is None:
-        max_len = max(seq_lens)
+        max_len = int(seq_lens.max())
+    ids = np.fromiter(chain.from_iterable(seqs), dtype=np.int64, count=int(seq_lens.sum()))
     # default pad index is 0
-    padded_seqs = torch.zeros([len(seqs), max_len]).long()
-    for i, seq in enumerate(seqs): 
-        seq_len = seq_lens[i]
-        padded_seqs[i, :seq_len] = seq[:seq_len]
-    return padded_seqs, torch.Tensor(seq_lens)
+    if buffer is None:
+        padded_seqs = torch.zeros([len(seqs), max_len]).long()
+    else:
+        padded_seqs = buffer.get(len(seqs), max_len)
+    padded_seqs.numpy()[np.arange(max_len) < seq_lens[:, None]] = ids
+    return padded_seqs, torch.from_numpy(seq_lens).float()
+
+def gen_batch_sampler(dataset, config, train=True):
+    # index batches of an epoch outside a data loader
+    args = gen_batch_args(dataset, config, train)
+    if 'batch_sampler' in args:
+        return args['batch_sampler']
+    if args['shuffle']:
+        sampler = torch_data.RandomSampler(dataset)
+    else:
+        sampler = torch_data.SequentialSampler(dataset)
+    return torch_data.BatchSampler(sampler, args['batch_size'], args['drop_last'])
+
+
+# a pool of processes that build online training batches ahead of the training loop
+# ready batches are written into the slots of a ring buffer in shared memory
+# producers wait for a free slot, so at most depth batches are ahead
+class BatchProducer(object):
+    """docstring for BatchProducer"""
+    def __init__(self, dataset, collate_fn, batch_sampler, num_producers, depth, slot_size=None, seed=0):
+        super(BatchProducer, self).__init__()
+        self.dataset = dataset
+        self.collate_fn = collate_fn
+        self.batch_sampler = batch_sampler
+        self.num_producers = num_producers
+        self.depth = depth
+        self.slot_size = slot_size
+        self.seed = seed
+        self.epoch = 0
+        self.processes = []
+        # seconds spent waiting, by the training loop on ready batches
+        # and by each producer on free slots
+        self.consumer_stall = 0.
+        self.producer_stalls = mp.RawArray('d', num_producers)
+        self.num_batches = 0
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def start(self):
+        if self.slot_size is None:
+            # twice the int64 values of a sample batch
+            idxes = next(iter(self.batch_sampler))
+            batch = self.collate_fn([self.dataset[i] for i in idxes])
+            self.slot_size = 2 * sum(t.numel() for t in batch)
+        self.slots = torch.from_numpy(np.frombuffer(
+            mp.RawArray('q', self.depth*self.slot_size), dtype=np.int64)).view(self.depth, self.slot_size)
+        # batches are dealt to producers in turn, so that each batch comes from a fixed stream
+        self.index_queues = [mp.Queue() for _ in range(self.num_producers)]
+        self.free_queue, self.ready_queue = mp.Queue(), mp.Queue()
+        for slot in range(self.depth):
+            self.free_queue.put(slot)
+        for i in range(self.num_producers):
+            process = mp.Process(target=self.produce, args=(i, ), daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    def produce(self, i):
+        global PRODUCER_ID
+        PRODUCER_ID = i + 1
+        seed_epoch = None
+        while True:
+            epoch, idxes = self.index_queues[i].get()
+            # producers draw from their own stream in each epoch
+            if epoch != seed_epoch:
+                seed_worker_rng(self.seed, epoch)
+                seed_epoch = epoch
+            try:
+                batch = self.collate_fn([self.dataset[idx] for idx in idxes])
+            except Exception:
+                self.ready_queue.put((epoch, None, traceback.format_exc()))
+                continue
+            start_time = time.time()
+            slot = self.free_queue.get()
+            self.producer_stalls[i] += time.time() - start_time
+            self.ready_queue.put((epoch, slot, self.write(slot, batch)))
+
+    def write(self, slot, batch):
+        # tensors are flattened into the slot one after another as int64
+        # a batch larger than the slot is sent whole instead
+        # copied, since the collate buffers are reused for the next batch
+        if sum(t.numel() for t in batch) > self.slot_size:
+            return tuple(t.clone() for t in batch)
+        metas, offset = [], 0
+        for t in batch:
+            self.slots[slot, offset:offset+t.numel()] = t.reshape(-1)
+            metas.append((offset, tuple(t.shape), t.dtype))
+            offset += t.numel()
+        return metas
+
+    def read(self, slot, metas):
+        # views of the slot, valid until the next batch
+        if isinstance(metas, tuple):
+            return metas
+        return tuple(self.slots[slot, offset:offset+int(np.prod(shape))].view(shape).to(dtype) 
+            for offset, shape, dtype in metas)
+
+    def __iter__(self):
+        if not self.processes:
+            self.start()
+        self.epoch += 1
+        num_batches = 0
+        for idxes in self.batch_sampler:
+            self.index_queues[num_batches % self.num_producers].put((self.epoch, list(idxes)))
+            num_batches += 1
+        slot = None
+        try:
+            while num_batches:
+                start_time = time.time()
+                epoch, slot, metas = self.ready_queue.get()
+                self.consumer_stall += time.time() - start_time
+                if slot is None:
+                    if epoch == self.epoch:
+                        raise RuntimeError('Batch producer failed:\n{}'.format(metas))
+                    continue
+                if epoch == self.epoch:
+                    num_batches -= 1
+                    self.num_batches += 1
+                    yield self.read(slot, metas)
+                # batches left over from an interrupted epoch are dropped
+                self.free_queue.put(slot)
+                slot = None
+        finally:
+            if slot is not None:
+                self.free_queue.put(slot)
+
+    def stall_info(self):
+        # waiting of the training loop points to generation as the bottleneck
+        # and waiting of the producers to compute
+        producer_stalls = list(self.producer_stalls)
+        return {'batches': self.num_batches, 
+            'consumer_stall': round(self.consumer_stall, 2), 
+            'producer_stall': round(sum(producer_stalls) / max(len(producer_stalls), 1), 2)}
+
+    def close(self):
+        # producers may be blocked on a full buffer
+        for process in self.processes:
+            process.terminate()
+            process.join()
+        self.processes = []
 
 def is_int(v):
     try:
@@ -685,18 +903,16 @@ def is_int(v):
 def parse_pos(pos):
     return int(''.join([i for i in pos if i.isdigit()]))
 
-def one_step_infer(xs, ys_, src_idx2vocab_dict, src_vocab2idx_dict, tgt_idx2vocab_dict, config): 
+def one_step_infer(xs, ys_, src_vocab, tgt_vocab, config): 
     # detach from devices
     xs = xs.cpu().detach().numpy() 
     ys_ = torch.argmax(ys_, dim=2).cpu().detach().numpy() 
+    # mask completed sequences
+    mask = ~(ys_ == tgt_vocab.vocab2idx_dict.get('<done>', -1)).all(axis=-1)
     # remove padding idx
-    xs = [rm_idx(x, config.pad_idx) for x in xs] 
-    # print(translate(ys_[0], tgt_idx2vocab_dict))
     # convert index to vocab
-    xs = [translate(x, src_idx2vocab_dict) for x in xs]
-    ys_ = [translate(y_, tgt_idx2vocab_dict) for y_ in ys_]
-    # mask completed sequences
-    mask = ~(np.array(ys_) == '<done>').all(axis=-1)
+    xs = src_vocab.decode(Vocab.strip_pad(xs, config.pad_idx))
+    ys_ = tgt_vocab.decode(ys_)
     if not mask.any():
         done = True
     else:
@@ -715,9 +931,7 @@ def one_step_infer(xs, ys_, src_idx2vocab_dict, src_vocab2idx_dict, tgt_idx2voca
             for i in idxes: 
                 x, y_ = xs[i], ys_[i]
                 if y_[0].startswith('<pos_') and y_[1].startswith('<pos_') and y_[2].isdigit():
-                    left_idx = parse_pos(y_[0])
-                    right_idx = parse_pos(y_[1])
-                    xs[i] = x[:left_idx] + [y_[2]] + x[right_idx+1:]
+                    xs[i] = apply_aes_spans(x, [(parse_pos(y_[0]), parse_pos(y_[1]), y_[2])])
         # inference function for Arithmetic Equation Correction (AEC) 
         elif config.data_src == 'aec': 
             # for loop inference
@@ -725,38 +939,37 @@ def one_step_infer(xs, ys_, src_idx2vocab_dict, src_vocab2idx_dict, tgt_idx2voca
                 x, y_ = xs[i], ys_[i]
                 if y_[1].startswith('<pos_'):
                     pos = parse_pos(y_[1])
-                    if y_[0] == '<sub>' and pos in range(len(x)) and y_[2] in src_vocab2idx_dict: 
+                    if y_[0] == '<sub>' and pos in range(len(x)) and y_[2] in src_vocab: 
                         x[pos] = y_[2]
                     elif y_[0] == '<delete>' and pos in range(len(x)):
                         del x[pos]
-                    elif y_[0] == '<insert>' and y_[2] in src_vocab2idx_dict:
+                    elif y_[0] == '<insert>' and y_[2] in src_vocab:
                         x.insert(pos, y_[2])
                 xs[i] = x
             
+    xs = src_vocab.encode(xs)
     if config.data_src == 'aor':
-        xs = [torch.Tensor(translate(x, src_vocab2idx_dict)) for x in xs]
         xs, x_lens = padding(xs, config.L*2)
     else:
-        xs = [torch.Tensor(translate(x, src_vocab2idx_dict)) for x in xs]
         xs, x_lens = padding(xs)
 
     return xs.to(config.device), x_lens.to(config.device), done
 
 def rec_infer(xs, x_lens, model, max_infer_step, 
-    src_idx2vocab_dict, src_vocab2idx_dict, tgt_idx2vocab_dict, config, done=False):
+    src_vocab, tgt_vocab, config, done=False):
     # recursive inference in valudation and testing
     # if config.data_src in ['aoi']:
     if max_infer_step == 0:
         return xs, x_lens, False
     else:
         xs, x_lens, done = rec_infer(xs, x_lens, model, max_infer_step-1, 
-            src_idx2vocab_dict, src_vocab2idx_dict, tgt_idx2vocab_dict, config, done) 
+            src_vocab, tgt_vocab, config, done) 
         if done:
             return xs, x_lens, done
         else:
             ys_ = model(xs, x_lens) 
             xs, x_lens, done = one_step_infer(xs, ys_, 
-                src_idx2vocab_dict, src_vocab2idx_dict, tgt_idx2vocab_dict, config)
+                src_vocab, tgt_vocab, config)
             return xs, x_lens, done
 
 def tag_execute(x, y_):
@@ -793,10 +1006,10 @@ def tag_execute(x, y_):
     # return prediction
     return p
 
-def tag_infer(xs, ys_, src_idx2vocab_dict, src_vocab2idx_dict, tgt_idx2vocab_dict):
+def tag_infer(xs, ys_, src_vocab, tgt_vocab):
     # convert index to vocab
-    xs = [translate(x, src_idx2vocab_dict) for x in xs]
-    ys_ = [translate(y_, tgt_idx2vocab_dict) for y_ in ys_]
+    xs = src_vocab.decode(xs)
+    ys_ = tgt_vocab.decode(ys_)
     preds = [tag_execute(x, y_) for x, y_ in zip(xs, ys_)]
     # convert vocab to index
-    return [translate(p, src_vocab2idx_dict) for p in preds]
\ No newline at end of file
+    return src_vocab.encode(preds)
\ No newline at end of file
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+__author__ = 'Shining'
+__email__ = 'mrshininnnnn@gmail.com'
+
+# dependency
+# public
+import os
+import json
+import shutil
+import numpy as np
+
+
+# array-backed token sequences
+# the i-th sequence is tokens[offsets[i]:offsets[i+1]] in symbol ids
+# numpy buffers are never touched by reference counting
+# so forked data loader workers share them instead of copying them page by page
+class TokenArray(object):
+    """docstring for TokenArray"""
+    def __init__(self, tokens, offsets, symbols):
+        super(TokenArray, self).__init__()
+        self.tokens = tokens
+        self.offsets = offsets
+        self.symbols = symbols
+        self.size = len(offsets) - 1
+
+    def open(self):
+        return self.tokens, self.offsets
+
+    def __len__(self):
+        return self.size
+
+    def lens(self):
+        # the length of every sequence
+        tokens, offsets = self.open()
+        return np.diff(offsets)
+
+    def get_ids(self, idx):
+        # a view of the symbol ids of a sequence
+        tokens, offsets = self.open()
+        return tokens[offsets[idx]:offsets[idx+1]]
+
+    def __getitem__(self, idx):
+        return [self.symbols[i] for i in self.get_ids(idx).tolist()]
+
+
+# memory-mapped token store
+# each split and field of data.json is saved as a token array on disk
+class TokenSequence(TokenArray):
+    """docstring for TokenSequence"""
+    def __init__(self, path, symbols):
+        self.path = path
+        super(TokenSequence, self).__init__(*self.load(), symbols)
+
+    def load(self):
+        # plain array views of the maps, which are sliced much faster than memmap objects
+        return (np.load(self.path + '.npy', mmap_mode='r').view(np.ndarray), 
+            np.load(self.path + '_offsets.npy', mmap_mode='r').view(np.ndarray))
+
+    def open(self):
+        # arrays are mapped again after pickling so that each worker maps its own
+        if self.tokens is None:
+            self.tokens, self.offsets = self.load()
+        return self.tokens, self.offsets
+
+    def __getstate__(self):
+        # workers get the paths instead of the mapped arrays
+        state = self.__dict__.copy()
+        state['tokens'], state['offsets'] = None, None
+        return state
+
+def load_token_file(path: str) -> TokenSequence:
+    # token ids saved by the data generators with --format npy
+    # they share the layout of the store, and their symbols are listed in vocab.txt next to them
+    with open(os.path.join(os.path.dirname(path), 'vocab.txt'), 'r', encoding='utf-8') as f:
+        symbols = f.read().splitlines()
+    return TokenSequence(path, symbols)
+
+def gen_token_array(seqs: list, symbols: list = None) -> TokenArray:
+    # pack token lists into a token array in memory
+    if isinstance(seqs, TokenArray):
+        return seqs
+    if symbols is None:
+        symbols = sorted(set(token for seq in seqs for token in seq))
+    symbol2idx = {symbol: i for i, symbol in enumerate(symbols)}
+    dtype = np.int16 if len(symbols) <= np.iinfo(np.int16).max else np.int32
+    tokens = np.array([symbol2idx[token] for seq in seqs for token in seq], dtype=dtype)
+    offsets = np.zeros(len(seqs)+1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(seq) for seq in seqs])
+    return TokenArray(tokens, offsets, symbols)
+
+def save_store(data_dict: dict, store_path: str) -> None:
+    # convert a data dictionary of token lists to a token store
+    symbols = sorted(set(token for split in data_dict.values() 
+        for seqs in split.values() for seq in seqs for token in seq))
+    # written aside and moved in place once complete
+    tmp_path = '{}.{}.tmp'.format(store_path.rstrip(os.sep), os.getpid())
+    os.makedirs(tmp_path)
+    for split, split_dict in data_dict.items():
+        for field, seqs in split_dict.items():
+            path = os.path.join(tmp_path, '{}_{}'.format(split, field))
+            token_array = gen_token_array(seqs, symbols)
+            np.save(path + '.npy', token_array.tokens)
+            np.save(path + '_offsets.npy', token_array.offsets)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'symbols': symbols, 
+            'fields': {split: list(split_dict) for split, split_dict in data_dict.items()}}, f)
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    os.replace(tmp_path, store_path)
+
+def load_store(store_path: str) -> dict:
+    # a data dictionary of memory-mapped token sequences
+    with open(os.path.join(store_path, 'meta.json'), 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    return {split: {field: TokenSequence(os.path.join(store_path, '{}_{}'.format(split, field)), meta['symbols'])
+        for field in fields} for split, fields in meta['fields'].items()}
+
+def load_data_dict(data_path: str, store_path: str) -> dict:
+    # data.json is converted on first use and again whenever it changes
+    meta_path = os.path.join(store_path, 'meta.json')
+    if os.path.exists(data_path) and (not os.path.exists(meta_path) 
+        or os.path.getmtime(meta_path) < os.path.getmtime(data_path)):
+        with open(data_path, 'r', encoding='utf-8') as f:
+            save_store(json.load(f), store_path)
+    return load_store(store_path)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+__author__ = 'Shining'
+__email__ = 'mrshininnnnn@gmail.com'
+
+# dependency
+# public
+import numpy as np
+from itertools import chain
+
+
+def split_rows(flat: list, lens: list) -> list:
+    # cut a flat list into rows of the given lengths
+    ends = np.cumsum(lens).tolist()
+    return [flat[end-l:end] for end, l in zip(ends, lens)]
+
+
+# a vocabulary that converts whole batches at once
+# indices are decoded by indexing a token array with the id matrix
+# tokens are encoded by locating them in a sorted token table and gathering their indices
+class Vocab(object):
+    """docstring for Vocab"""
+    def __init__(self, vocab2idx_dict):
+        super(Vocab, self).__init__()
+        self.vocab2idx_dict = vocab2idx_dict
+        self.idx2vocab_dict = {v: k for k, v in vocab2idx_dict.items()}
+        # idx to token
+        self.idx2vocab = np.empty(max(self.idx2vocab_dict)+1, dtype=object)
+        self.idx2vocab[list(self.idx2vocab_dict)] = list(self.idx2vocab_dict.values())
+        # token to idx as a dense table over the sorted tokens
+        # one spare character keeps longer unknown tokens from matching a truncated one
+        tokens = sorted(vocab2idx_dict)
+        self.tokens = np.array(tokens, dtype='<U{}'.format(max(map(len, tokens)) + 1))
+        self.token2idx = np.array([vocab2idx_dict[token] for token in tokens], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.vocab2idx_dict)
+
+    def __contains__(self, token):
+        return token in self.vocab2idx_dict
+
+    def __getitem__(self, token):
+        return self.vocab2idx_dict[token]
+
+    def encode(self, seqs: list, end_idx: int = None) -> list:
+        # token lists to index lists
+        lens = [len(seq) for seq in seqs]
+        flat = np.fromiter(chain.from_iterable(seqs), dtype=self.tokens.dtype, count=sum(lens))
+        codes = np.minimum(np.searchsorted(self.tokens, flat), len(self.tokens)-1)
+        found = self.tokens[codes] == flat
+        if not found.all():
+            raise KeyError(list(chain.from_iterable(seqs))[np.argmin(found)])
+        ids = split_rows(self.token2idx[codes].tolist(), lens)
+        if end_idx is not None:
+            # add end symbol
+            for seq in ids:
+                seq.append(end_idx)
+        return ids
+
+    def decode(self, seqs) -> list:
+        # index matrices or index lists to token lists
+        if isinstance(seqs, np.ndarray):
+            return self.idx2vocab[seqs].tolist()
+        lens = [len(seq) for seq in seqs]
+        ids = np.fromiter(chain.from_iterable(seqs), dtype=np.int64, count=sum(lens))
+        return split_rows(self.idx2vocab[ids].tolist(), lens)
+
+    @staticmethod
+    def strip_pad(seqs: np.ndarray, pad_idx: int, end_idx: int = None) -> list:
+        # padded index matrix to index lists
+        seqs = np.asarray(seqs)
+        mask = seqs != pad_idx
+        if end_idx is not None:
+            # drop everything after the first end symbol
+            ends = (seqs == end_idx) & mask
+            mask &= np.cumsum(ends, axis=1) - ends == 0
+        return split_rows(seqs[mask].tolist(), mask.sum(axis=1).tolist())
@@ -17,8 +17,10 @@ from datetime import datetime
 # private
 from config import RecConfig
 from src.utils.eva import Evaluate
+from src.utils.vocab import Vocab
 from src.utils.save import *
 from src.utils.load import *
+from src.utils.store import *
 from src.utils.pipeline import *
 
 
@@ -35,8 +37,6 @@ class TextEditor(object):
         self.finished = False # training done flag
         self.setup_gpu()
         self.load_vocab()
-        self.load_data()
-        self.setup_model()
         # data src specific
         if self.config.data_src == 'aes':
             self.aes = ArithmeticEquationSimplification(self.config)
@@ -44,8 +44,13 @@ class TextEditor(object):
             self.aes = None
         if self.config.data_src == 'aec':
             self.aec = ArithmeticEquationCorrection(self.config)
+            # inputs and targets share the source vocab
+            init_editops_cache(list(self.src_vocab.vocab2idx_dict), 
+                self.config.editops_cache_size, max(self.config.num_workers, self.config.num_producers))
         else: 
             self.aec = None
+        self.load_data()
+        self.setup_model()
 
     def setup_gpu(self): 
         # verify devices which can be either cpu or gpu
@@ -55,26 +60,25 @@ class TextEditor(object):
     def load_vocab(self):
         # load the vocab dictionary and update config
         vocab_dict = load_json(self.config.VOCAB_PATH)
-        self.src_vocab2idx_dict = vocab_dict['src']
-        self.tgt_vocab2idx_dict = vocab_dict['tgt']
-        self.src_idx2vocab_dict = {v: k for k, v in self.src_vocab2idx_dict.items()}
-        self.tgt_idx2vocab_dict = {v: k for k, v in self.tgt_vocab2idx_dict.items()}
-        self.config.pad_idx = self.src_vocab2idx_dict[self.config.pad_symbol]
-        self.config.start_idx = self.tgt_vocab2idx_dict[self.config.start_symbol]
-        self.config.src_vocab_size = len(self.src_vocab2idx_dict)
-        self.config.tgt_vocab_size = len(self.tgt_vocab2idx_dict)
+        self.src_vocab = Vocab(vocab_dict['src'])
+        self.tgt_vocab = Vocab(vocab_dict['tgt'])
+        self.config.pad_idx = self.src_vocab[self.config.pad_symbol]
+        self.config.start_idx = self.tgt_vocab[self.config.start_symbol]
+        self.config.src_vocab_size = len(self.src_vocab)
+        self.config.tgt_vocab_size = len(self.tgt_vocab)
 
     def train_recursion_collate_fn(self, data):
         # a customized collate function used in the data loader 
         data.sort(key=len, reverse=True)
         # sampling for many2one task such as aes and aec
-        data = inverse_sampler(data, self.config.data_src, self.aes, self.aec)
-        xs, ys = data_generator(data, self.config)
+        rng = get_worker_rng()
+        data = inverse_sampler(data, self.config.data_src, rng, self.aes, self.aec)
+        xs, ys = data_generator(data, self.config, rng)
         # convert to index, add end symbol, and save as tensor
         xs, ys = preprocess(
-            xs, ys, self.src_vocab2idx_dict, self.tgt_vocab2idx_dict, self.config)
-        xs, x_lens = padding(xs)
-        ys, _ = padding(ys)
+            xs, ys, self.src_vocab, self.tgt_vocab, self.config)
+        xs, x_lens = padding(xs, buffer=self.x_buffer)
+        ys, _ = padding(ys, buffer=self.y_buffer)
 
         return xs, x_lens, ys
 
@@ -84,51 +88,63 @@ class TextEditor(object):
         xs, ys = zip(*data)
         # convert to index, add end symbol, and save as tensor
         xs, ys = preprocess(
-            xs, ys, self.src_vocab2idx_dict, self.src_vocab2idx_dict, self.config)
+            xs, ys, self.src_vocab, self.src_vocab, self.config)
         if self.config.data_mode == 'online' and self.config.data_src == 'aor': 
-            xs, x_lens = padding(xs, self.config.L*2)
+            xs, x_lens = padding(xs, self.config.L*2, self.x_buffer)
         else:
-            xs, x_lens = padding(xs)
-        ys, _ = padding(ys)
+            xs, x_lens = padding(xs, buffer=self.x_buffer)
+        ys, _ = padding(ys, buffer=self.y_buffer)
 
         return xs, x_lens, ys
 
+    def seed_worker(self, worker_id): 
+        # each data loader worker draws from its own random stream
+        seed_worker_rng(self.config.seed, self.epoch)
+
     def load_data(self): 
-        # read data dictionary from json file
-        self.data_dict = load_json(self.config.DATA_PATH)
+        # read data dictionary from the token store
+        # converted from the json file on first use
+        self.data_dict = load_data_dict(self.config.DATA_PATH, self.config.STORE_PATH)
+        # padded batches are written into reused buffers without workers
+        self.x_buffer, self.y_buffer = gen_batch_buffers(self.config)
         # train data loader
         if self.config.data_mode == 'online' or self.config.data_src in ['aes', 'aec']: 
-            self.train_dataset = OnlineDataset(data_dict=self.data_dict['train'])
+            self.train_dataset = OnlineDataset(data_dict=self.data_dict['train'], aes=self.aes, aec=self.aec)
         else:
             self.train_dataset = OfflineDataset(data_dict=self.data_dict['train'])
-        self.trainset_generator = torch_data.DataLoader(
-              self.train_dataset, 
-              batch_size=self.config.batch_size, 
-              collate_fn=self.train_recursion_collate_fn, 
-              shuffle=self.config.shuffle, 
-              num_workers=self.config.num_workers, 
-              pin_memory=self.config.pin_memory, 
-              drop_last=self.config.drop_last)
+        if self.config.data_mode == 'online' and self.config.num_producers > 0: 
+            # online batches are generated ahead by a pool of producers
+            self.trainset_generator = BatchProducer(
+                self.train_dataset, 
+                self.train_recursion_collate_fn, 
+                gen_batch_sampler(self.train_dataset, self.config), 
+                self.config.num_producers, 
+                self.config.producer_depth, 
+                seed=self.config.seed)
+        else:
+            self.trainset_generator = torch_data.DataLoader(
+                  self.train_dataset, 
+                  collate_fn=self.train_recursion_collate_fn, 
+                  num_workers=self.config.num_workers, 
+                  pin_memory=self.config.pin_memory, 
+                  worker_init_fn=self.seed_worker, 
+                  **gen_batch_args(self.train_dataset, self.config, True))
         # valid data loader
         self.val_dataset = OfflineDataset(data_dict=self.data_dict['val'])
         self.valset_generator = torch_data.DataLoader(
             self.val_dataset, 
-            batch_size=self.config.batch_size, 
             collate_fn=self.test_recursion_collate_fn, 
-            shuffle=False, 
               num_workers=self.config.num_workers, 
               pin_memory=self.config.pin_memory, 
-            drop_last=False)
+            **gen_batch_args(self.val_dataset, self.config, False))
         # test data loader
         self.test_dataset = OfflineDataset(data_dict=self.data_dict['test'])
         self.testset_generator = torch_data.DataLoader(
               self.test_dataset, 
-              batch_size=self.config.batch_size, 
               collate_fn=self.test_recursion_collate_fn, 
-              shuffle=False, 
               num_workers=self.config.num_workers, 
               pin_memory=self.config.pin_memory, 
-              drop_last=False)
+              **gen_batch_args(self.test_dataset, self.config, False))
         # update config
         self.config.train_size = len(self.train_dataset)
         self.config.train_batch = len(self.trainset_generator)
@@ -163,19 +179,21 @@ class TextEditor(object):
         while not self.finished:
             print('\nTraining...')
             self.model.train()
+            # random streams of this epoch
+            seed_worker_rng(self.config.seed, self.epoch)
             # training set data loader
             trainset_generator = tqdm(self.trainset_generator)
             for data in trainset_generator: 
                 data = (d.to(self.config.device) for d in data)
                 xs, x_lens, ys = data
                 # print(x_lens.cpu().detach().numpy()[0])
-                # print(translate(xs.cpu().detach().numpy()[0], self.src_idx2vocab_dict))
-                # print(translate(ys.cpu().detach().numpy()[0], self.tgt_idx2vocab_dict))
+                # print(self.src_vocab.decode(xs.cpu().detach().numpy()[0]))
+                # print(self.tgt_vocab.decode(ys.cpu().detach().numpy()[0]))
             #     break
             # break
                 ys_ = self.model(xs, x_lens, ys, teacher_forcing_ratio=self.config.teacher_forcing_ratio)
                 loss = self.criterion(ys_.reshape(-1, self.config.tgt_vocab_size), ys.reshape(-1))
-                # print(translate(torch.argmax(ys_, dim=2).cpu().detach().numpy()[0], self.tgt_idx2vocab_dict))
+                # print(self.tgt_vocab.decode(torch.argmax(ys_, dim=2).cpu().detach().numpy()[0]))
                 # break
             # break
                 # update step
@@ -192,13 +210,17 @@ class TextEditor(object):
             ys_ = torch.argmax(ys_, dim=2).cpu().detach().numpy() # batch_size, max_ys_seq_len
             xs, ys, ys_ = post_process(xs, ys, ys_, self.config)
             # evaluation
-            eva_matrix = Evaluate(self.config, ys, ys_, self.tgt_idx2vocab_dict, True)
+            eva_matrix = Evaluate(self.config, ys, ys_, self.tgt_vocab.idx2vocab_dict, True)
             eva_msg = 'Train Epoch {} Total Step {} Loss:{:.4f} '.format(self.epoch, self.step, loss)
             eva_msg += eva_matrix.eva_msg
             print(eva_msg)
+            if self.config.data_src == 'aec':
+                print('Editops Cache {}'.format(editops_cache_info()))
+            if isinstance(self.trainset_generator, BatchProducer):
+                print('Producer Stall {}'.format(self.trainset_generator.stall_info()))
             # random sample to show
             src, tar, pred = rand_sample(xs, ys, ys_, 
-                self.src_idx2vocab_dict, self.tgt_idx2vocab_dict, self.tgt_idx2vocab_dict)
+                self.src_vocab, self.tgt_vocab, self.tgt_vocab)
             print(' src: {}\n tar: {}\n pred: {}'.format(src, tar, pred))
             # val
             self.validate()
@@ -240,11 +262,11 @@ class TextEditor(object):
                 data = (d.to(self.config.device) for d in data)
                 xs, x_lens, ys = data
                 # print(x_lens.cpu().detach().numpy()[0])
-                # print(translate(xs.cpu().detach().numpy()[0], self.src_idx2vocab_dict))
-                # print(translate(ys.cpu().detach().numpy()[0], self.src_idx2vocab_dict))
+                # print(self.src_vocab.decode(xs.cpu().detach().numpy()[0]))
+                # print(self.src_vocab.decode(ys.cpu().detach().numpy()[0]))
                 # break
                 ys_ = rec_infer(xs, x_lens, model, self.config.max_infer_step, 
-                    self.src_idx2vocab_dict, self.src_vocab2idx_dict, self.tgt_idx2vocab_dict, self.config)[0]
+                    self.src_vocab, self.tgt_vocab, self.config)[0]
                 xs = xs.cpu().detach().numpy() # batch_size, max_xs_seq_len
                 ys = ys.cpu().detach().numpy() # batch_size, max_ys_seq_len
                 ys_ = ys_.cpu().detach().numpy() # batch_size, max_ys_seq_len
@@ -254,14 +276,14 @@ class TextEditor(object):
                 all_ys_ += ys_
                 # break
         # evaluation
-        eva_matrix = Evaluate(self.config, all_ys, all_ys_, self.src_idx2vocab_dict)
+        eva_matrix = Evaluate(self.config, all_ys, all_ys_, self.src_vocab.idx2vocab_dict)
         eva_msg = 'Val Epoch {} Total Step {} '.format(self.epoch, self.step)
         eva_msg += eva_matrix.eva_msg
         print(eva_msg)
         self.val_log.append(eva_msg)
         # random sample to show
         src, tar, pred = rand_sample(all_xs, all_ys, all_ys_, 
-            self.src_idx2vocab_dict, self.src_idx2vocab_dict, self.src_idx2vocab_dict)
+            self.src_vocab, self.src_vocab, self.src_vocab)
         print(' src: {}\n tar: {}\n pred: {}'.format(src, tar, pred))
         # early stopping
         if eva_matrix.key_metric > self.val_key_metric:
@@ -270,9 +292,9 @@ class TextEditor(object):
             # save model
             save_check_point(self.step, self.epoch, self.model.state_dict, self.opt.state_dict, self.config.SAVE_POINT)
         # save test output
-        self.val_src = [' '.join(translate(x, self.src_idx2vocab_dict)) for x in all_xs]
-        self.val_tgt = [' '.join(translate(y, self.src_idx2vocab_dict)) for y in all_ys]
-        self.val_pred = [' '.join(translate(y_, self.src_idx2vocab_dict)) for y_ in all_ys_]
+        self.val_src = [' '.join(x) for x in self.src_vocab.decode(all_xs)]
+        self.val_tgt = [' '.join(y) for y in self.src_vocab.decode(all_ys)]
+        self.val_pred = [' '.join(y_) for y_ in self.src_vocab.decode(all_ys_)]
 
     def test(self):
         print('\nTesting...')
@@ -291,11 +313,11 @@ class TextEditor(object):
                 data = (d.to(self.config.device) for d in data)
                 xs, x_lens, ys = data
                 # print(x_lens.cpu().detach().numpy()[0])
-                # print(translate(xs.cpu().detach().numpy()[0], self.src_idx2vocab_dict))
-                # print(translate(ys.cpu().detach().numpy()[0], self.src_idx2vocab_dict))
+                # print(self.src_vocab.decode(xs.cpu().detach().numpy()[0]))
+                # print(self.src_vocab.decode(ys.cpu().detach().numpy()[0]))
                 # break
                 ys_ = rec_infer(xs, x_lens, model, self.config.max_infer_step, 
-                    self.src_idx2vocab_dict, self.src_vocab2idx_dict, self.tgt_idx2vocab_dict, self.config)[0]
+                    self.src_vocab, self.tgt_vocab, self.config)[0]
                 xs = xs.cpu().detach().numpy() # batch_size, max_xs_seq_len
                 ys = ys.cpu().detach().numpy() # batch_size, max_ys_seq_len
                 ys_ = ys_.cpu().detach().numpy() # batch_size, max_ys_seq_len
@@ -304,19 +326,19 @@ class TextEditor(object):
                 all_ys += ys 
                 all_ys_ += ys_
                 # break
-        eva_matrix = Evaluate(self.config, all_ys, all_ys_, self.src_idx2vocab_dict)
+        eva_matrix = Evaluate(self.config, all_ys, all_ys_, self.src_vocab.idx2vocab_dict)
         eva_msg = 'Test Epoch {} Total Step {} '.format(self.epoch, self.step)
         eva_msg += eva_matrix.eva_msg
         print(eva_msg)
         self.test_log.append(eva_msg)
         # random sample to show
         src, tar, pred = rand_sample(xs, ys, ys_, 
-            self.src_idx2vocab_dict, self.src_idx2vocab_dict, self.src_idx2vocab_dict)
+            self.src_vocab, self.src_vocab, self.src_vocab)
         print(' src: {}\n tar: {}\n pred: {}'.format(src, tar, pred))
         # save test output
-        self.test_src = [' '.join(translate(x, self.src_idx2vocab_dict)) for x in all_xs]
-        self.test_tgt = [' '.join(translate(y, self.src_idx2vocab_dict)) for y in all_ys]
-        self.test_pred = [' '.join(translate(y_, self.src_idx2vocab_dict)) for y_ in all_ys_]
+        self.test_src = [' '.join(x) for x in self.src_vocab.decode(all_xs)]
+        self.test_tgt = [' '.join(y) for y in self.src_vocab.decode(all_ys)]
+        self.test_pred = [' '.join(y_) for y_ in self.src_vocab.decode(all_ys_)]
 
 def main(): 
     # initial everything
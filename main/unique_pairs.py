@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+__author__ = 'Shining'
+__email__ = 'mrshininnnnn@gmail.com'
+
+# dependency
+# public
+import argparse
+from tqdm import tqdm
+# private
+from config import E2EConfig, RecConfig, TagConfig
+from src.utils.pipeline import BatchProducer, record_pairs, seed_worker_rng
+
+
+# to check that online workers draw new samples instead of the same ones
+def count_pairs(te, epoch: int) -> tuple:
+    # the unique (x, y_) pairs drawn in an online training epoch
+    te.epoch = epoch
+    seed_worker_rng(te.config.seed, epoch)
+    pairs, num_pairs = set(), 0
+    for data in tqdm(te.trainset_generator):
+        record_pairs(pairs, *data, te.config.pad_idx)
+        num_pairs += len(data[0])
+    return pairs, num_pairs
+
+def gen_editor(num_workers: int, num_producers: int):
+    # the text editor of the method in config.py with online training data
+    method = E2EConfig().method
+    if method == 'e2e':
+        from train_e2e import TextEditor
+        config = E2EConfig()
+    elif method == 'rec':
+        from train_rec import TextEditor
+        config = RecConfig()
+    elif method == 'tag':
+        from train_tag import TextEditor
+        config = TagConfig()
+    config.data_mode = 'online'
+    config.num_workers = num_workers
+    config.num_producers = num_producers
+    return TextEditor(config)
+
+def main():
+    # example
+    # python unique_pairs.py --num_workers 0 1 2 4 --epochs 2
+    # parameters
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_workers',
+        type=int,
+        nargs='+',
+        default=[0, 1, 2, 4],
+        help='defines the numbers of data loader workers to compare')
+    parser.add_argument('--num_producers',
+        type=int,
+        nargs='+',
+        default=[0],
+        help='defines the numbers of batch producers to compare, 0 for data loader workers')
+    parser.add_argument('--epochs',
+        type=int,
+        default=2,
+        help='defines the number of online training epochs to draw')
+    args = parser.parse_args()
+    for num_producers in args.num_producers:
+        # producers replace the data loader workers
+        for num_workers in args.num_workers if num_producers == 0 else [0]:
+            te = gen_editor(num_workers, num_producers)
+            epoch_pairs = []
+            for epoch in range(args.epochs):
+                pairs, num_pairs = count_pairs(te, epoch)
+                print('workers {} producers {} epoch {} unique pairs {}/{}'.format(
+                    num_workers, num_producers, epoch, len(pairs), num_pairs))
+                epoch_pairs.append(pairs)
+            if args.epochs > 1:
+                print('epochs differ', epoch_pairs[0] != epoch_pairs[1])
+            if isinstance(te.trainset_generator, BatchProducer):
+                te.trainset_generator.close()
+
+if __name__ == '__main__':
+    main()